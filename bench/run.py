@@ -0,0 +1,525 @@
+#
+#   Offline benchmarks for the Spotify plugin
+#
+#   Runs plugin.py against local stand-ins for Spotify and Domoticz and writes the timings as JSON, e.g.:
+#       python3 bench/run.py --latency 0.05 --output results-0.4.json --compare results-0.3.json
+#
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import fakeDomoticz
+import plugin
+from standins import SpotifyStandin, DomoticzStandin
+
+WAIT_TIMEOUT = 10
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(values):
+    return {"count": len(values),
+            "min_ms": round(min(values) * 1000, 3),
+            "median_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "max_ms": round(max(values) * 1000, 3)}
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.homeFolder = tempfile.mkdtemp(prefix='spotify-bench-')
+        standinArgs = {"latency": args.latency, "errorRate": args.error_rate, "rateLimitRate": args.rate_limit_rate,
+                       "etags": not args.no_etags, "gzip": not args.no_gzip}
+        self.spotify = SpotifyStandin(tls=args.tls, **standinArgs).start()
+        self.domoticz = DomoticzStandin(variables={"Spotify-searchTxt": "playlist Morning"}, **standinArgs).start()
+        self.seedTokens()
+        fakeDomoticz.quiet = not args.verbose
+
+    def seedTokens(self):
+        # tokens as an older version left them in the user variables, the plugin moves them to its state file
+        token = self.spotify.issueToken()
+        self.domoticz.addVariable("Spotify-access_token", token['access_token'])
+        self.domoticz.addVariable("Spotify-refresh_token", token['refresh_token'])
+        self.domoticz.addVariable("Spotify-retrievaldate", str(time.time()))
+
+    def close(self):
+        self.spotify.stop()
+        self.domoticz.stop()
+        shutil.rmtree(self.homeFolder, ignore_errors=True)
+
+    def newPlugin(self):
+        fakeDomoticz.reset()
+        fakeDomoticz.Parameters.update({"Name": "Spotify",
+                                        "HomeFolder": self.homeFolder + os.sep,
+                                        "Address": "127.0.0.1",
+                                        "Port": str(self.domoticz.port),
+                                        "Mode1": "client-id",
+                                        "Mode2": "client-secret",
+                                        "Mode3": "code",
+                                        "Mode5": "1",
+                                        "Mode6": "Debug" if self.args.verbose else "Normal"})
+        instance = plugin.BasePlugin()
+        instance.spotifyAccountUrl = self.spotify.accountUrl
+        instance.spotifyApiUrl = self.spotify.apiUrl
+        if self.args.tls:
+            instance.transport = plugin.HttpConnectionPool(ssl_context=self.spotify.sslContext(),
+                                                           metrics=instance.metrics)
+        # the scenarios fire requests back to back, which the real rate limit would only throttle
+        instance.rateLimiter = plugin.RateLimiter(rate=self.args.rate, burst=max(10, int(self.args.rate)))
+        plugin._plugin = instance
+        return instance
+
+    def requests(self, since):
+        return {"spotify": self.spotify.count() - since[0], "domoticz": self.domoticz.count() - since[1],
+                "spotify_bytes": self.spotify.bytesSent - since[2]}
+
+    def counts(self):
+        return self.spotify.count(), self.domoticz.count(), self.spotify.bytesSent
+
+    def waitForResults(self, instance):
+        deadline = time.time() + WAIT_TIMEOUT
+        while instance.engine.results.empty() and time.time() < deadline:
+            time.sleep(0.001)
+        instance.engine.processResults()
+
+    def watchCallback(self, instance, name):
+        # Event that is set after every call of the named result callback, other background results do not count
+        event = threading.Event()
+        callback = getattr(instance, name)
+
+        def watched(result):
+            try:
+                return callback(result)
+            finally:
+                event.set()
+        setattr(instance, name, watched)
+        return event
+
+    def waitForCallback(self, instance, event):
+        deadline = time.time() + WAIT_TIMEOUT
+        while not event.is_set() and time.time() < deadline:
+            time.sleep(0.001)
+            instance.engine.processResults()
+        event.clear()
+
+    def startPlugin(self, instance):
+        # onStart returns right away, beat like Domoticz does until the background bootstrap is done
+        plugin.onStart()
+        deadline = time.time() + WAIT_TIMEOUT
+        while instance.startup.get("pending") and not instance.blError and time.time() < deadline:
+            time.sleep(0.001)
+            plugin.onHeartbeat()
+
+    def scenarioStart(self, restored):
+        callbacks = []
+        ready = []
+        before = self.counts()
+        for run in range(self.args.repeat):
+            snapshot = os.path.join(self.homeFolder, plugin.STATE_FILE.format(fakeDomoticz.Parameters["HardwareID"]))
+            if not restored and os.path.exists(snapshot):
+                os.remove(snapshot)
+            if not restored:
+                self.seedTokens()
+            instance = self.newPlugin()
+            self.startPlugin(instance)
+            callbacks.append(instance.startup["onStart"])
+            if "ready" in instance.startup:
+                ready.append(instance.startup["ready"])
+            plugin.onStop()
+        return {"callback": summarize(callbacks),
+                "ready": summarize(ready) if ready else None,
+                "requests_per_run": dict((key, value / float(self.args.repeat))
+                                         for key, value in self.requests(before).items())}
+
+    def scenarioCommand(self, cached):
+        instance = self.newPlugin()
+        self.startPlugin(instance)
+        callbacks = []
+        endToEnd = []
+        before = self.counts()
+        for run in range(self.args.repeat):
+            if not cached:
+                instance.searchCache.entries.clear()
+            # a single command, not a burst that the command pipeline debounces
+            time.sleep(plugin.COMMAND_DEBOUNCE)
+            played = self.spotify.expect('PUT', '/v1/me/player/play')
+            start = time.time()
+            plugin.onCommand(1, 'Set Level', 10 if run % 2 else 20, '')
+            callbacks.append(time.time() - start)
+            if played.wait(WAIT_TIMEOUT):
+                endToEnd.append(time.time() - start)
+            self.waitForResults(instance)
+        requests = self.requests(before)
+        stats = instance.transport.stats()
+        plugin.onStop()
+        return {"callback": summarize(callbacks),
+                "end_to_end": summarize(endToEnd) if endToEnd else None,
+                "failed": self.args.repeat - len(endToEnd),
+                "requests_per_run": dict((key, value / float(self.args.repeat)) for key, value in requests.items()),
+                "transport": stats}
+
+    def commandsSettled(self, instance):
+        stats = instance.commands.stats()
+        return stats["dropped"] + stats["executed"] == stats["submitted"] and not instance.commands.busy
+
+    def scenarioBurst(self):
+        # levels changed in quick succession, like scrolling through the selector
+        instance = self.newPlugin()
+        self.startPlugin(instance)
+        settled = []
+        matched = 0
+        before = self.counts()
+        for run in range(self.args.repeat):
+            time.sleep(plugin.COMMAND_DEBOUNCE)
+            start = time.time()
+            for level in (10, 20, 10, 20, 10):
+                plugin.onCommand(1, 'Set Level', level, '')
+                time.sleep(0.02)
+            deadline = time.time() + WAIT_TIMEOUT
+            while not self.commandsSettled(instance) and time.time() < deadline:
+                time.sleep(0.001)
+            settled.append(time.time() - start)
+            self.waitForResults(instance)
+            playing = self.spotify.playing
+            if playing is not None and playing['device']['id'] == instance.selectorIndex.device('10'):
+                matched += 1
+        requests = self.requests(before)
+        stats = instance.commands.stats()
+        plugin.onStop()
+        return {"settled": summarize(settled),
+                "final_state_matched": matched,
+                "requests_per_run": dict((key, value / float(self.args.repeat)) for key, value in requests.items()),
+                "commands": stats}
+
+    def scenarioTracks(self):
+        # 'tracks' search with a long result: playback starts with the first page, a second play request adds the
+        # later pages in the order of the search result. A later command has to play its own context next.
+        self.spotify.searchTotal = self.args.queue_max * 2
+        self.spotify.queue = []
+        self.domoticz.variables["Spotify-searchTxt"]["Value"] = 'tracks Coldplay'
+        self.domoticz.addVariable('Spotify-queueMax', str(self.args.queue_max))
+        instance = self.newPlugin()
+        self.startPlugin(instance)
+        firstSound = []
+        allTracks = []
+        queued = []
+        inOrder = True
+        expected = self.spotify.search('Coldplay', ['track'], {'limit': self.args.queue_max})['tracks']['items']
+        before = self.counts()
+        for run in range(self.args.repeat):
+            time.sleep(plugin.COMMAND_DEBOUNCE)
+            played = self.spotify.expect('PUT', '/v1/me/player/play')
+            start = time.time()
+            plugin.onCommand(1, 'Set Level', 10 if run % 2 else 20, '')
+            if played.wait(WAIT_TIMEOUT):
+                firstSound.append(time.time() - start)
+            self.waitForResults(instance)
+            deadline = time.time() + WAIT_TIMEOUT
+            while instance.trackPages.stats()["pending"] and time.time() < deadline:
+                time.sleep(0.001)
+                instance.engine.processResults()
+            allTracks.append(time.time() - start)
+            order = self.spotify.playOrder()
+            queued.append(len(order))
+            inOrder = inOrder and order == [item['uri'] for item in expected]
+        requests = self.requests(before)
+        stats = instance.trackPages.stats()
+
+        self.domoticz.variables["Spotify-searchTxt"]["Value"] = 'playlist Morning'
+        time.sleep(plugin.COMMAND_DEBOUNCE)
+        played = self.spotify.expect('PUT', '/v1/me/player/play')
+        plugin.onCommand(1, 'Set Level', 10, '')
+        played.wait(WAIT_TIMEOUT)
+        self.waitForResults(instance)
+        playing = self.spotify.playing
+        ownContextNext = playing is not None and self.spotify.upNext() == playing['request'].get('context_uri')
+        plugin.onStop()
+
+        self.spotify.searchTotal = 10
+        self.domoticz.variables.pop('Spotify-queueMax', None)
+        return {"first_sound": summarize(firstSound),
+                "all_tracks": summarize(allTracks),
+                "tracks": min(queued),
+                "in_order": inOrder,
+                "own_context_next": ownContextNext,
+                "requests_per_run": dict((key, value / float(self.args.repeat)) for key, value in requests.items()),
+                "pages": stats}
+
+    def scenarioControls(self):
+        # volume changes and skips while playing: shown is the device state when onCommand returns, confirmed the
+        # time until the playback state check after the command is applied
+        instance = self.newPlugin()
+        self.startPlugin(instance)
+        played = self.spotify.expect('PUT', '/v1/me/player/play')
+        plugin.onCommand(1, 'Set Level', 10, '')
+        played.wait(WAIT_TIMEOUT)
+        self.waitForResults(instance)
+        checkDelay = plugin.CONTROL_CHECK_DELAY
+        plugin.CONTROL_CHECK_DELAY = self.args.check_delay
+        callbacks = []
+        confirmed = []
+        shown = 0
+        matched = 0
+        before = self.counts()
+        for run in range(self.args.repeat):
+            unit, level = (plugin.VOLUME, 30 if run % 4 else 60) if run % 2 else (plugin.CONTROLS, 40)
+            start = time.time()
+            plugin.onCommand(unit, 'Set Level', level, '')
+            callbacks.append(time.time() - start)
+            if fakeDomoticz.Devices[unit].sValue == str(level):
+                shown += 1
+            deadline = time.time() + WAIT_TIMEOUT
+            while instance.controlPending and time.time() < deadline:
+                time.sleep(0.001)
+                instance.engine.processResults()
+            confirmed.append(time.time() - start)
+            if unit == plugin.VOLUME and fakeDomoticz.Devices[unit].sValue == str(level) or \
+                    unit == plugin.CONTROLS and fakeDomoticz.Devices[unit].sValue == '0':
+                matched += 1
+        requests = self.requests(before)
+
+        # refused by spotify: the volume device is set back
+        self.spotify.playing = None
+        volume = fakeDomoticz.Devices[plugin.VOLUME].sValue
+        plugin.onCommand(plugin.VOLUME, 'Set Level', 5, '')
+        deadline = time.time() + WAIT_TIMEOUT
+        while instance.controlPending and time.time() < deadline:
+            time.sleep(0.001)
+            instance.engine.processResults()
+        rolledBack = fakeDomoticz.Devices[plugin.VOLUME].sValue == volume
+        plugin.CONTROL_CHECK_DELAY = checkDelay
+        plugin.onStop()
+        return {"callback": summarize(callbacks),
+                "confirmed": summarize(confirmed),
+                "shown": shown,
+                "final_state_matched": matched,
+                "rolled_back": rolledBack,
+                "requests_per_run": dict((key, value / float(self.args.repeat)) for key, value in requests.items())}
+
+    def scenarioHeartbeat(self):
+        instance = self.newPlugin()
+        self.startPlugin(instance)
+        callbacks = []
+        polls = []
+        applied = self.watchCallback(instance, 'onPlaybackState')
+        before = self.counts()
+        for run in range(self.args.repeat):
+            instance.pollScheduler.nextPoll = 0
+            start = time.time()
+            plugin.onHeartbeat()
+            callbacks.append(time.time() - start)
+            self.waitForCallback(instance, applied)
+            polls.append(time.time() - start)
+        requests = self.requests(before)
+        plugin.onStop()
+        return {"callback": summarize(callbacks),
+                "poll_applied": summarize(polls),
+                "requests_per_run": dict((key, value / float(self.args.repeat)) for key, value in requests.items())}
+
+    def scenarioDeviceRefresh(self):
+        # the periodic device list refresh, apply_cpu is the time spent on the plugin thread handling the result
+        instance = self.newPlugin()
+        self.startPlugin(instance)
+        timings = []
+        applied = []
+        done = threading.Event()
+
+        def onDevicesRefreshed(spotDevices):
+            timings.append(time.time() - start)
+            cpu = time.thread_time()
+            instance.onDevicesRefreshed(spotDevices)
+            applied.append(time.thread_time() - cpu)
+            done.set()
+
+        before = self.counts()
+        for run in range(self.args.repeat):
+            start = time.time()
+            instance.engine.submit(instance.spotDevices, callback=onDevicesRefreshed)
+            self.waitForCallback(instance, done)
+        requests = self.requests(before)
+        stats = instance.responseCache.stats()
+        plugin.onStop()
+        return {"fetched": summarize(timings),
+                "apply_cpu": summarize(applied),
+                "requests_per_run": dict((key, value / float(self.args.repeat)) for key, value in requests.items()),
+                "response_cache": stats}
+
+    def scenarioAccounts(self):
+        # one plugin instance serving --accounts extra accounts next to the one of the hardware parameters
+        names = ['account{}'.format(number) for number in range(1, self.args.accounts + 1)]
+        self.domoticz.addVariable('Spotify-accounts', ','.join(names))
+        for name in names:
+            self.domoticz.addVariable('Spotify-{}-code'.format(name), 'code-' + name)
+        threadsBefore = threading.active_count()
+        instance = self.newPlugin()
+        start = time.time()
+        self.startPlugin(instance)
+        deadline = time.time() + WAIT_TIMEOUT
+        while len([account for account in instance.accounts.values() if account.ready() or account.blError]) < \
+                len(names) and time.time() < deadline:
+            time.sleep(0.001)
+            plugin.onHeartbeat()
+        ready = time.time() - start
+        failed = len([account for account in instance.accounts.values() if not account.ready()])
+
+        # make every account due at once, the heartbeats spread the polls
+        pollsPerBeat = []
+        for account in instance.allAccounts():
+            account.pollScheduler.nextPoll = 0
+        before = self.counts()
+        budget = instance.pollBudget()
+        for beat in range(len(names) // budget + 2):
+            polled = self.spotify.count('/v1/me/player')
+            plugin.onHeartbeat()
+            time.sleep(self.args.latency * 2 + 0.01)
+            pollsPerBeat.append(self.spotify.count('/v1/me/player') - polled)
+        requests = self.requests(before)
+        threads = threading.active_count() - threadsBefore
+        timers = plugin._timerWheel.pending()
+        plugin.onStop()
+
+        for name in names:
+            self.domoticz.variables.pop('Spotify-{}-code'.format(name), None)
+        self.domoticz.variables.pop('Spotify-accounts', None)
+        return {"accounts": len(names),
+                "all_ready_ms": round(ready * 1000, 3),
+                "failed": failed,
+                "threads": threads,
+                "token_timers": timers,
+                "poll_budget": budget,
+                "max_polls_per_beat": max(pollsPerBeat),
+                "poll_requests": requests["spotify"]}
+
+    def scenarioTokenRefresh(self):
+        instance = self.newPlugin()
+        self.startPlugin(instance)
+        timings = []
+        before = self.counts()
+        for run in range(self.args.repeat):
+            start = time.time()
+            instance.tokenRefresher.refreshNow()
+            timings.append(time.time() - start)
+        requests = self.requests(before)
+        plugin.onStop()
+        result = summarize(timings)
+        result["requests_per_run"] = dict((key, value / float(self.args.repeat)) for key, value in requests.items())
+        return result
+
+    def run(self):
+        scenarios = {"onStart": lambda: self.scenarioStart(False),
+                     "onStart_restored": lambda: self.scenarioStart(True),
+                     "onCommand": lambda: self.scenarioCommand(False),
+                     "onCommand_cached_search": lambda: self.scenarioCommand(True),
+                     "onCommand_burst": self.scenarioBurst,
+                     "onCommand_tracks": self.scenarioTracks,
+                     "controls": self.scenarioControls,
+                     "onHeartbeat": self.scenarioHeartbeat,
+                     "device_refresh": self.scenarioDeviceRefresh,
+                     "token_refresh": self.scenarioTokenRefresh,
+                     "accounts": self.scenarioAccounts}
+        selected = self.args.scenario or sorted(scenarios)
+        results = {}
+        for name in selected:
+            sys.stderr.write('Running {}\n'.format(name))
+            results[name] = scenarios[name]()
+        return {"meta": {"timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         "python": platform.python_version(),
+                         "machine": platform.machine(),
+                         "latency": self.args.latency,
+                         "error_rate": self.args.error_rate,
+                         "rate_limit_rate": self.args.rate_limit_rate,
+                         "etags": not self.args.no_etags,
+                         "gzip": not self.args.no_gzip,
+                         "tls": self.args.tls,
+                         "repeat": self.args.repeat},
+                "scenarios": results}
+
+
+def medians(result, prefix=''):
+    # flattens all median_ms values, keyed by their path
+    found = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            found.update(medians(value, prefix + key + '.'))
+        elif key == 'median_ms':
+            found[prefix + key] = value
+    return found
+
+
+def compare(current, previous, threshold, minDelta):
+    regressions = []
+    old = medians(previous["scenarios"])
+    for key, value in sorted(medians(current["scenarios"]).items()):
+        if key not in old or not old[key]:
+            continue
+        change = (value - old[key]) / old[key]
+        sys.stderr.write('{key}: {old:.3f} -> {new:.3f} ms ({change:+.1%})\n'.format(
+            key=key, old=old[key], new=value, change=change))
+        # sub-millisecond callbacks move by more than the threshold on scheduler noise alone
+        if change > threshold and value - old[key] > minDelta:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the Spotify plugin')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every stand-in response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='chance of a 500 response')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='chance of a 429 response')
+    parser.add_argument('--no-etags', action='store_true', help='stand-ins send no ETag and never answer 304')
+    parser.add_argument('--tls', action='store_true',
+                        help='Spotify stand-in serves HTTPS with a self-signed certificate')
+    parser.add_argument('--no-gzip', action='store_true', help='stand-ins never compress responses')
+    parser.add_argument('--accounts', type=int, default=20, help='extra accounts in the accounts scenario')
+    parser.add_argument('--queue-max', type=int, default=200, help='queueMax in the onCommand_tracks scenario')
+    parser.add_argument('--check-delay', type=float, default=0.1,
+                        help='seconds before the playback state check in the controls scenario')
+    parser.add_argument('--rate', type=float, default=1000.0, help='requests per second of the plugin rate limiter')
+    parser.add_argument('--scenario', action='append', help='scenario to run, can be repeated (default all)')
+    parser.add_argument('--output', help='write the results to this JSON file instead of stdout')
+    parser.add_argument('--compare', help='JSON file of an earlier run, fail on median regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed median regression (default 0.2)')
+    parser.add_argument('--min-delta', type=float, default=0.5,
+                        help='ignore regressions smaller than this many ms (default 0.5)')
+    parser.add_argument('--verbose', action='store_true', help='show the plugin log')
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    try:
+        results = bench.run()
+    finally:
+        bench.close()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as previous:
+            regressions = compare(results, json.load(previous), args.threshold, args.min_delta)
+        if regressions:
+            sys.stderr.write('Regressions: {}\n'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+#
+#   Local stand-in servers for the Spotify accounts/Web API and the Domoticz json.htm API
+#
+
+import http.server
+import hashlib
+import gzip
+import os
+import shutil
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import random
+import json
+import time
+import urllib.parse
+
+
+GZIP_MIN_SIZE = 200
+
+
+def selfSignedCertificate():
+    # Certificate and key for 127.0.0.1 made with the openssl command line tool, returns the folder and both paths
+    folder = tempfile.mkdtemp(prefix='spotify-bench-tls-')
+    certFile = os.path.join(folder, 'cert.pem')
+    keyFile = os.path.join(folder, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                           '-keyout', keyFile, '-out', certFile],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return folder, certFile, keyFile
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def handle_request(self, method):
+        standin = self.server.standin
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        standin.record(method, url.path, len(body))
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        status, headers, payload = standin.injectedError()
+        if status is None:
+            status, headers, payload = standin.respond(method, url.path, query, body, self.headers)
+
+        data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        headers = dict(headers)
+        if standin.etags and status == 200 and data:
+            headers['ETag'] = '"{}"'.format(hashlib.md5(data).hexdigest())
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                status, data = 304, b''
+        if data:
+            headers['Content-Type'] = 'application/json'
+        if standin.gzip and len(data) >= GZIP_MIN_SIZE and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with standin.lock:
+            standin.bytesSent += len(data)
+
+
+class Standin:
+    # Base class, runs a threaded HTTP/1.1 server on a free local port. latency is added to every request, errorRate
+    # and rateLimitRate are the chances of answering 500 or 429 instead. etags adds an ETag to every 200 response and
+    # answers a matching If-None-Match with 304, gzip compresses the larger bodies when the client accepts it. tls
+    # serves HTTPS with a self-signed certificate, clients trust it with sslContext().
+    def __init__(self, latency=0.0, errorRate=0.0, rateLimitRate=0.0, retryAfter=1, etags=True, gzip=True,
+                 tls=False):
+        self.latency = latency
+        self.etags = etags
+        self.gzip = gzip
+        self.errorRate = errorRate
+        self.rateLimitRate = rateLimitRate
+        self.retryAfter = retryAfter
+        self.lock = threading.Lock()
+        self.requests = []
+        self.bytesSent = 0
+        self.waiters = []
+        self.server = ThreadingServer(('127.0.0.1', 0), StandinHandler)
+        self.server.standin = self
+        self.thread = None
+        self.certFolder = None
+        self.certFile = None
+        if tls:
+            self.certFolder, self.certFile, keyFile = selfSignedCertificate()
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certFile, keyFile)
+            # the handshake runs on the handler thread, not in the accept loop
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True,
+                                                     do_handshake_on_connect=False)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def url(self):
+        return '{scheme}://127.0.0.1:{port}'.format(scheme='https' if self.certFile else 'http', port=self.port)
+
+    def sslContext(self):
+        return ssl.create_default_context(cafile=self.certFile)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.certFolder:
+            shutil.rmtree(self.certFolder, ignore_errors=True)
+
+    def record(self, method, path, size):
+        with self.lock:
+            self.requests.append((time.time(), method, path))
+            for waiter in list(self.waiters):
+                if waiter[0] == method and waiter[1] == path:
+                    waiter[2].set()
+                    self.waiters.remove(waiter)
+
+    def expect(self, method, path):
+        # Event that is set when the next matching request comes in
+        event = threading.Event()
+        with self.lock:
+            self.waiters.append((method, path, event))
+        return event
+
+    def count(self, path=None):
+        with self.lock:
+            return len([request for request in self.requests if path is None or request[2] == path])
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+            self.bytesSent = 0
+
+    def injectedError(self):
+        draw = random.random()
+        if draw < self.rateLimitRate:
+            return 429, {'Retry-After': str(self.retryAfter)}, {'error': {'status': 429, 'message': 'API rate limit'}}
+        if draw < self.rateLimitRate + self.errorRate:
+            return 500, {}, {'error': {'status': 500, 'message': 'Server error'}}
+        return None, None, None
+
+    def respond(self, method, path, query, body, headers):
+        return 404, {}, None
+
+
+class SpotifyStandin(Standin):
+    # Serves /api/token like accounts.spotify.com and /v1/... like api.spotify.com. A search finds searchTotal items
+    # of every type, served in pages of the requested limit. Like on Spotify the queue outlives play requests.
+    def __init__(self, devices=None, searchTotal=10, **kwargs):
+        Standin.__init__(self, **kwargs)
+        self.searchTotal = searchTotal
+        self.tokenCounter = 0
+        self.accessToken = 'access-0'
+        self.validTokens = set()
+        self.devices = devices or [{'id': 'dev-kitchen', 'name': 'Kitchen', 'type': 'Speaker', 'volume_percent': 40},
+                                   {'id': 'dev-living', 'name': 'Living room', 'type': 'Speaker', 'volume_percent': 65}]
+        self.playing = None
+        self.queue = []
+        self.controls = {'next': lambda query: self.skip(1),
+                         'previous': lambda query: self.skip(-1),
+                         'seek': lambda query: self.playing.update(
+                             started=time.time() - int(query['position_ms']) / 1000.0),
+                         'volume': lambda query: self.playing['device'].update(
+                             volume_percent=int(query['volume_percent'])),
+                         'shuffle': lambda query: self.playing.update(shuffle=query['state'] == 'true'),
+                         'repeat': lambda query: self.playing.update(repeat=query['state'])}
+
+    @property
+    def accountUrl(self):
+        return self.url + '/api/token'
+
+    @property
+    def apiUrl(self):
+        return self.url + '/v1'
+
+    def issueToken(self):
+        with self.lock:
+            self.tokenCounter += 1
+            self.accessToken = 'access-{}'.format(self.tokenCounter)
+            self.validTokens.add(self.accessToken)
+        return {'access_token': self.accessToken, 'token_type': 'Bearer', 'expires_in': 3600,
+                'refresh_token': 'refresh-token', 'scope': 'user-read-playback-state user-modify-playback-state'}
+
+    def respond(self, method, path, query, body, headers):
+        if path == '/api/token':
+            return 200, {}, self.issueToken()
+
+        # every issued token stays valid, several accounts can be signed in at once
+        if (headers.get('Authorization') or '')[len('Bearer '):] not in self.validTokens:
+            return 401, {}, {'error': {'status': 401, 'message': 'The access token expired'}}
+
+        if path == '/v1/me/player/devices':
+            return 200, {}, {'devices': self.devices}
+        if path == '/v1/search':
+            return 200, {}, self.search(query.get('q', ''), query.get('type', 'track').split(','), query)
+        if path == '/v1/me/player/play' and method == 'PUT':
+            request = json.loads(body.decode('utf-8')) if body else {}
+            device = next((device for device in self.devices if device['id'] == query.get('device_id')), None)
+            if device is None:
+                return 404, {}, {'error': {'status': 404, 'message': 'Device not found'}}
+            offset = (request.get('offset') or {}).get('position', 0)
+            self.playing = {'device': device, 'request': request, 'track': offset, 'shuffle': False, 'repeat': 'off',
+                            'started': time.time() - request.get('position_ms', 0) / 1000.0}
+            return 204, {}, None
+        if path.startswith('/v1/me/player/') and path[len('/v1/me/player/'):] in self.controls:
+            if self.playing is None:
+                return 404, {}, {'error': {'status': 404, 'message': 'Player command failed: No active device found'}}
+            self.controls[path[len('/v1/me/player/'):]](query)
+            return 204, {}, None
+        if path == '/v1/me/player/queue' and method == 'POST':
+            if self.playing is None:
+                return 404, {}, {'error': {'status': 404, 'message': 'No active device found'}}
+            self.queue.append(query.get('uri'))
+            return 204, {}, None
+        if path == '/v1/me/player/pause' and method == 'PUT':
+            self.playing = None
+            return 204, {}, None
+        if path == '/v1/me/player':
+            return self.playbackState()
+
+        return 404, {}, {'error': {'status': 404, 'message': 'Service not found'}}
+
+    def search(self, searchQuery, searchTypes, query):
+        limit = int(query.get('limit', 20))
+        offset = int(query.get('offset', 0))
+        end = min(offset + limit, self.searchTotal)
+        result = {}
+        for searchType in searchTypes:
+            items = []
+            for number in range(offset, end):
+                items.append({'name': '{} {}'.format(searchQuery, number), 'type': searchType,
+                              'uri': 'spotify:{}:{}{}'.format(searchType, searchQuery.replace(' ', ''), number),
+                              'popularity': 100 - number,
+                              'artists': [{'name': 'Artist {}'.format(number)}]})
+            following = None
+            if end < self.searchTotal:
+                following = '{url}/v1/search?{query}'.format(url=self.url, query=urllib.parse.urlencode(
+                    dict(query, type=searchType, offset=end)))
+            result[searchType + 's'] = {'items': items, 'total': self.searchTotal, 'limit': limit, 'offset': offset,
+                                        'next': following}
+        return result
+
+    def playOrder(self):
+        # Spotify plays the queue after the current track and only then the rest of the play request
+        if self.playing is None:
+            return list(self.queue)
+        uris = self.playing['request'].get('uris', [])
+        track = self.playing['track']
+        return uris[:track + 1] + self.queue + uris[track + 1:]
+
+    def upNext(self):
+        # what plays after the current track: the queue, else the play request
+        if self.queue:
+            return self.queue[0]
+        if self.playing is None:
+            return None
+        uris = self.playing['request'].get('uris')
+        if uris is None:
+            return self.playing['request'].get('context_uri')
+        return uris[self.playing['track'] + 1] if self.playing['track'] + 1 < len(uris) else None
+
+    def trackUri(self):
+        uris = self.playing['request'].get('uris') or []
+        if self.playing['track'] < len(uris):
+            return uris[self.playing['track']]
+        return 'spotify:track:song{}'.format(self.playing['track'])
+
+    def skip(self, step):
+        self.playing['track'] = max(0, self.playing['track'] + step)
+        self.playing['started'] = time.time()
+
+    def playbackState(self):
+        if self.playing is None:
+            return 204, {}, None
+        progress = int((time.time() - self.playing['started']) * 1000)
+        return 200, {}, {'is_playing': True, 'device': self.playing['device'], 'progress_ms': progress,
+                         'shuffle_state': self.playing['shuffle'], 'repeat_state': self.playing['repeat'],
+                         'item': {'name': 'Song {}'.format(self.playing['track']), 'duration_ms': 180000,
+                                  'uri': self.trackUri(),
+                                  'artists': [{'name': 'Artist'}], 'album': {'name': 'Album'}}}
+
+
+class DomoticzStandin(Standin):
+    # Serves the user variable commands of /json.htm
+    def __init__(self, variables=None, **kwargs):
+        Standin.__init__(self, **kwargs)
+        self.variables = {}
+        self.nextIdx = 1
+        for name, value in (variables or {}).items():
+            self.addVariable(name, value)
+
+    def addVariable(self, name, value):
+        self.variables[name] = {'idx': str(self.nextIdx), 'Name': name, 'Type': '2', 'Value': value,
+                                'LastUpdate': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.nextIdx += 1
+
+    def respond(self, method, path, query, body, headers):
+        if path != '/json.htm':
+            return 404, {}, None
+
+        param = query.get('param')
+        with self.lock:
+            if param == 'getuservariables':
+                return 200, {}, {'status': 'OK', 'title': 'GetUserVariables', 'result': list(self.variables.values())}
+            if param == 'getuservariable':
+                result = [item for item in self.variables.values() if item['idx'] == query.get('idx')]
+                return 200, {}, {'status': 'OK', 'title': 'GetUserVariable', 'result': result}
+            if param == 'adduservariable':
+                if query.get('vname') in self.variables:
+                    return 200, {}, {'status': 'ERR', 'message': 'Variable name already exists!'}
+                self.addVariable(query.get('vname'), query.get('vvalue', ''))
+                return 200, {}, {'status': 'OK', 'title': 'AddUserVariable'}
+            if param == 'deleteuservariable':
+                name = next((name for name, item in self.variables.items() if item['idx'] == query.get('idx')), None)
+                if name is None:
+                    return 200, {}, {'status': 'ERR', 'message': 'Variable does not exist'}
+                del self.variables[name]
+                return 200, {}, {'status': 'OK', 'title': 'DeleteUserVariable'}
+            if param == 'updateuservariable':
+                if query.get('vname') not in self.variables:
+                    return 200, {}, {'status': 'ERR', 'message': 'Variable does not exist'}
+                self.variables[query.get('vname')]['Value'] = query.get('vvalue', '')
+                return 200, {}, {'status': 'OK', 'title': 'UpdateUserVariable'}
+
+        return 200, {}, {'status': 'ERR', 'message': 'Unknown command'}
@@ -0,0 +1,102 @@
+#
+#   Fake Domoticz module, used when plugin.py runs outside of Domoticz
+#
+
+import sys
+
+Parameters = {"Name": "Spotify",
+              "HardwareID": 1,
+              "HomeFolder": "./",
+              "Address": "localhost",
+              "Port": "8080",
+              "Username": "",
+              "Password": "",
+              "Mode1": "",
+              "Mode2": "",
+              "Mode3": "",
+              "Mode4": "",
+              "Mode5": "10",
+              "Mode6": "Normal"}
+
+Devices = {}
+
+debugging = False
+heartbeat = None
+quiet = False
+messages = {"Log": [], "Error": [], "Debug": []}
+
+
+def Debugging(level):
+    global debugging
+    debugging = level != 0
+
+
+def Heartbeat(interval):
+    global heartbeat
+    heartbeat = interval
+
+
+def _message(kind, text):
+    messages[kind].append(str(text))
+    if not quiet:
+        sys.stderr.write('{}: {}\n'.format(kind, text))
+
+
+def Debug(text):
+    if debugging:
+        _message("Debug", text)
+
+
+def Log(text):
+    _message("Log", text)
+
+
+def Error(text):
+    _message("Error", text)
+
+
+def reset():
+    global debugging, heartbeat
+    Devices.clear()
+    debugging = False
+    heartbeat = None
+    for kind in messages:
+        messages[kind] = []
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0,
+                 **kwargs):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = dict(Options or {})
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.updates = 0
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def Update(self, nValue=None, sValue=None, Options=None, **kwargs):
+        if nValue is not None:
+            self.nValue = nValue
+        if sValue is not None:
+            self.sValue = sValue
+        if Options is not None:
+            self.Options = dict(Options)
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        self.updates += 1
+
+    def __str__(self):
+        return 'Unit {unit} {name}: nValue={nvalue}, sValue={svalue}'.format(
+            unit=self.Unit, name=self.Name, nvalue=self.nValue, svalue=self.sValue)
@@ -30,6 +30,7 @@
     		<options>
         		<option label="True" value="Debug"/>
         		<option label="False" value="Normal"  default="True" />
+        		<option label="Profile" value="Profile"/>
     		</options>
     	</param>
     </params>
@@ -49,32 +50,1621 @@ except ImportError:
 import urllib.request
 import urllib.error
 import urllib.parse
+import http.client
+import threading
+import queue
 import base64
 import json
 import time
+import io
+import gzip
+import socket
+import os
+import collections
+import math
+import bisect
+import heapq
+import itertools
+import http.server
+import cProfile
+import pstats
+import tracemalloc
 
 # DEFINES
 SPOTIFYDEVICES = 1
+NOWTRACK = 2
+NOWARTIST = 3
+NOWALBUM = 4
+NOWVOLUME = 5
+NOWPROGRESS = 6
+CONTROLS = 7
+VOLUME = 8
+PLAYMODE = 9
+ACCOUNT_UNITS = 10
+MAX_ACCOUNTS = 24
+METRICSCALLS = 240
+METRICSERRORS = 241
+METRICSLATENCY = 242
+POOL_MAXSIZE = 2
+POOL_IDLE_TIMEOUT = 50
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+SPOTIFY_TIMEOUT = (5, 15)
+DOMOTICZ_TIMEOUT = (3, 10)
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+HEARTBEAT_INTERVAL = 10
+STARTUP_HEARTBEAT = 1
+STATE_FILE = 'spotify_state_{}.json'
+LEGACY_STATE_FILE = 'spotify_state.json'
+POLL_UNIT = 30
+POLL_TRACK_END_DELAY = 2
+POLL_IDLE_MAX = 3600
+POLL_BOOST_INTERVAL = 10
+POLL_BOOST_WINDOW = 60
+WORKER_THREADS = 2
+WORKER_THREADS_MAX = 4
+ACCOUNTS_PER_WORKER = 10
+POLLS_PER_HEARTBEAT_MIN = 2
+COMMAND_DEBOUNCE = 0.3
+SEARCH_WAIT = 20
+SEARCH_MARKET = 'NL'
+SEARCH_TYPES = ('artist', 'track', 'playlist', 'album')
+SEARCH_LIMIT = 10
+SEARCH_CACHE_SIZE = 64
+SEARCH_CACHE_TTL = 24 * 3600
+SEARCH_CACHE_NEGATIVE_TTL = 300
+RESPONSE_CACHE_SIZE = 32
+QUEUE_TYPE = 'tracks'
+QUEUE_PAGE_SIZE = 50
+QUEUE_MAX_TRACKS = 100
+USERVAR_REFRESH = 600
+RATE_LIMIT_RATE = 1.0
+RATE_LIMIT_BURST = 10
+RATE_LIMIT_POLL_RESERVE = 5
+RATE_LIMIT_MAX_WAIT = 10
+PRIORITY_COMMAND = 0
+PRIORITY_POLL = 1
+POLL_STALE_AFTER = 10
+DEVICE_REFRESH = 900
+PROGRESS_UPDATE_INTERVAL = 60
+CONTROL_LEVELS = {'10': 'previous', '20': 'back', '30': 'forward', '40': 'next'}
+PLAYMODE_LEVELS = {'0': (False, 'off'), '10': (True, 'off'), '20': (False, 'context'), '30': (True, 'context'),
+                   '40': (False, 'track')}
+SEEK_STEP = 30
+VOLUME_DEFAULT = 50
+CONTROL_CHECK_DELAY = 1
+CONTROL_PENDING_MAX = 30
+PRESET_REFRESH = 24 * 3600
+METRICS_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+METRICS_INTERVAL = 3600
+TOKEN_LIFETIME = 3600
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_WAIT = 30
+PROFILE_SAMPLE = 10
+PROFILE_INTERVAL = 600
+PROFILE_TOP = 10
+PROFILE_KEEP = 5
+PROFILE_FILE = 'spotify_profile'
+
+
+#############################################################################
+#                      HTTP transport                                       #
+#############################################################################
+class HttpResponse:
+    # Minimal stand-in for the object returned by urllib.request.urlopen. The body is read completely before the
+    # connection goes back to the pool, so read() can be called after the request has finished.
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.code = status
+        self.reason = reason
+        self.msg = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class CircuitBreaker:
+    # Stops calling an upstream after a run of failures. While open every call fails fast, after the cool-down a
+    # single probe call is let through (half-open), which closes the breaker again when it succeeds.
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.openedAt = 0
+        self.probing = False
+        self.lock = threading.Lock()
+        self.counters = {"opened": 0, "rejected": 0}
+
+    def allow(self):
+        with self.lock:
+            if self.state == BREAKER_OPEN and time.time() >= self.openedAt + self.cooldown:
+                self.state = BREAKER_HALF_OPEN
+                self.probing = False
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self.state == BREAKER_HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.counters["rejected"] += 1
+            return False
+
+    def success(self):
+        with self.lock:
+            closing = self.state != BREAKER_CLOSED
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+            self.probing = False
+        if closing:
+            Domoticz.Log('{} is reachable again, circuit breaker closed'.format(self.name))
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            opening = self.state == BREAKER_HALF_OPEN or (self.state == BREAKER_CLOSED and
+                                                           self.failures >= self.threshold)
+            if opening:
+                self.state = BREAKER_OPEN
+                self.openedAt = time.time()
+                self.probing = False
+                self.counters["opened"] += 1
+        if opening:
+            Domoticz.Error('{name} failed {failures} times, circuit breaker open for {cooldown} seconds'.format(
+                name=self.name, failures=self.failures, cooldown=self.cooldown))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({"state": self.state, "failures": self.failures})
+        return stats
+
+
+class HttpConnectionPool:
+    # Keeps a few idle HTTP/1.1 connections per host, so consecutive calls to api.spotify.com and
+    # accounts.spotify.com skip the TCP and TLS handshake. Every host gets its own circuit breaker, timeout is a
+    # (connect, read) tuple in seconds.
+    def __init__(self, maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT, ssl_context=None, metrics=None,
+                 timeout=SPOTIFY_TIMEOUT):
+        self.maxsize = maxsize
+        self.metrics = metrics
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.idle = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "reconnects": 0, "bytes_received": 0}
+
+    def urlopen(self, req, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+
+        url = req.full_url
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+
+        headers = dict(req.header_items())
+        if req.data is not None and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        headers['Connection'] = 'keep-alive'
+        headers.setdefault('Accept-encoding', 'gzip')
+
+        breaker = self.getBreaker(parts.hostname)
+        if not breaker.allow():
+            raise urllib.error.URLError('circuit breaker for {} is open'.format(parts.hostname))
+
+        started = time.time()
+        method = req.get_method()
+        conn, reused = self.getConnection(key, timeout)
+        try:
+            sent = False
+            try:
+                self.send(conn, timeout, method, selector, req.data, headers)
+                sent = True
+                response, body = self.receive(conn)
+            except (http.client.HTTPException, OSError) as err:
+                conn.close()
+                if not reused or isinstance(err, socket.timeout):
+                    raise
+                # The server dropped the idle connection, retry once on a fresh one. A request that may have reached
+                # the server is only sent again when that is harmless, a POST like next or queue could run twice.
+                if sent and method not in IDEMPOTENT_METHODS:
+                    raise
+                with self.lock:
+                    self.counters["reconnects"] += 1
+                conn = self.newConnection(key, timeout)
+                self.send(conn, timeout, method, selector, req.data, headers)
+                response, body = self.receive(conn)
+        except (http.client.HTTPException, OSError) as err:
+            conn.close()
+            breaker.failure()
+            self.record(req, parts, 'error', started)
+            raise urllib.error.URLError(err)
+
+        self.record(req, parts, response.status, started)
+        with self.lock:
+            self.counters["bytes_received"] += len(body)
+        # the host answered, record that before anything else can raise, a half-open probe must always end
+        if response.status >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        if body and (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError) as err:
+                conn.close()
+                raise urllib.error.URLError(err)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.releaseConnection(key, conn)
+
+        result = HttpResponse(url, response.status, response.reason, response.msg, body)
+        if result.status >= 400:
+            raise urllib.error.HTTPError(url, result.status, result.reason, result.headers, io.BytesIO(body))
+
+        return result
+
+    def record(self, req, parts, status, started):
+        if self.metrics is not None:
+            self.metrics.record('{method} {host}{path}'.format(method=req.get_method(), host=parts.hostname,
+                                                                path=parts.path), status, time.time() - started)
+
+    def send(self, conn, timeout, method, selector, data, headers):
+        connectTimeout, readTimeout = timeout
+        if conn.sock is None:
+            conn.timeout = connectTimeout
+            conn.connect()
+        conn.sock.settimeout(readTimeout)
+        conn.request(method, selector, body=data, headers=headers)
+
+    def receive(self, conn):
+        response = conn.getresponse()
+        return response, response.read()
+
+    def getBreaker(self, host):
+        with self.lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = self.breakers[host] = CircuitBreaker(host)
+        return breaker
+
+    def getConnection(self, key, timeout):
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, releasedAt = idle.pop()
+                if now - releasedAt < self.idle_timeout:
+                    self.counters["hits"] += 1
+                    return conn, True
+                conn.close()
+            self.counters["misses"] += 1
+
+        return self.newConnection(key, timeout), False
+
+    def newConnection(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout[0], context=self.ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=timeout[0])
+
+    def releaseConnection(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["idle"] = sum(len(idle) for idle in self.idle.values())
+            breakers = list(self.breakers.values())
+        stats["breakers"] = dict((breaker.name, breaker.stats()) for breaker in breakers)
+        return stats
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, releasedAt in idle:
+                    conn.close()
+            self.idle = {}
+
+
+_domoticzTransport = HttpConnectionPool(timeout=DOMOTICZ_TIMEOUT)
+
+
+#############################################################################
+#                      Background execution                                 #
+#############################################################################
+class WorkerEngine:
+    # Runs blocking network work on a few worker threads. Results are handed back through a queue and their callbacks
+    # are executed by processResults(), which is called from the Domoticz callbacks, so devices are only ever updated
+    # from the plugin thread.
+    def __init__(self, workers=WORKER_THREADS):
+        self.workers = workers
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        self.threads = []
+
+    def start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(name='SpotifyWorker-{}'.format(len(self.threads) + 1), target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, args=(), callback=None):
+        self.tasks.put((func, args, callback))
+
+    def complete(self, func, callback, result=None):
+        # hands a result to processResults without running anything, for work that was dropped
+        self.results.put((func, callback, result, None))
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            func, args, callback = task
+            try:
+                result = _profiler.call(func, *args) if _profiler.enabled else func(*args)
+                error = None
+            except Exception as err:
+                result = None
+                error = err
+            self.results.put((func, callback, result, error))
+
+    def processResults(self):
+        while True:
+            try:
+                func, callback, result, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if error is not None:
+                Domoticz.Error('Background task {task} failed: {error}'.format(task=func.__name__, error=str(error)))
+            elif callback is not None:
+                try:
+                    callback(result)
+                except Exception as err:
+                    Domoticz.Error('Handling result of {task} failed: {error}'.format(task=func.__name__,
+                                                                                     error=str(err)))
+
+    def stop(self, timeout=5):
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+
+class CommandPipeline:
+    # Runs user commands one at a time on the worker engine, the last command wins. A command that follows another
+    # within the debounce window waits for the window to pass, and a command that is overtaken by a newer one before
+    # it started is dropped and returns None to its callback. Only the newest command waits, in the pipeline and not
+    # on a worker: it is handed to the engine when the window has passed and the running command is done.
+    def __init__(self, engine, debounce=COMMAND_DEBOUNCE, wheel=None):
+        self.engine = engine
+        self.debounce = debounce
+        self.wheel = wheel if wheel is not None else _timerWheel
+        self.lock = threading.Lock()
+        self.lastCommand = 0
+        self.deadline = 0
+        self.pending = None
+        self.busy = False
+        self.counters = {"submitted": 0, "dropped": 0, "executed": 0}
+
+    def submit(self, func, args=(), callback=None):
+        with self.lock:
+            now = time.time()
+            # a single command runs right away, only a burst of commands is debounced
+            self.deadline = now + self.debounce if now - self.lastCommand < self.debounce else now
+            self.lastCommand = now
+            self.counters["submitted"] += 1
+            dropped = self.pending
+            if dropped is not None:
+                self.counters["dropped"] += 1
+            self.pending = (func, args, callback)
+        if dropped is not None:
+            self.engine.complete(dropped[0], dropped[2])
+        self.dispatch()
+
+    def dispatch(self):
+        # Hands the pending command to the engine when it is due and nothing runs, called after every submit, by the
+        # timer at the end of the window and when a command is done
+        with self.lock:
+            if self.pending is None or self.busy:
+                return None
+            remaining = self.deadline - time.time()
+            if remaining > 0:
+                self.wheel.schedule(remaining, self.dispatch)
+                return None
+            func, args, callback = self.pending
+            self.pending = None
+            self.busy = True
+            self.counters["executed"] += 1
+        self.engine.submit(self.runCommand, (func, args), callback)
+
+    def runCommand(self, func, args):
+        # Runs on a worker thread
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.busy = False
+            self.dispatch()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=self.pending is not None)
+
+
+#############################################################################
+#                      Caching                                              #
+#############################################################################
+class SearchCache:
+    # Bounded LRU cache with a time to live per entry. A value of None is a cached empty search result. Expiry times
+    # are wall clock times, so a snapshot written to disk stays valid after a restart.
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, negative_ttl=SEARCH_CACHE_NEGATIVE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "joined": 0}
+        self.inflight = {}
+
+    @staticmethod
+    def makeKey(search_input, search_type, market):
+        return '{}|{}|{}'.format(' '.join(search_input.lower().split()), search_type, market)
+
+    def get(self, key):
+        # Returns a (found, value) tuple, as None is a valid cached value
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.time():
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return True, value
+                del self.entries[key]
+                self.counters["expired"] += 1
+            self.counters["misses"] += 1
+            return False, None
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.counters["evicted"] += 1
+
+    def claim(self, key):
+        # Single flight per key: returns (True, event) for the caller that has to search, the others get (False,
+        # event) and wait for the event before reading the cache
+        with self.lock:
+            event = self.inflight.get(key)
+            if event is not None:
+                self.counters["joined"] += 1
+                return False, event
+            event = self.inflight[key] = threading.Event()
+            return True, event
+
+    def release(self, key):
+        with self.lock:
+            event = self.inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+        return stats
+
+    def restore(self, entries):
+        # entries as returned by dump(), expired ones are skipped
+        now = time.time()
+        try:
+            with self.lock:
+                for key, value, expires in entries:
+                    if expires > now:
+                        self.entries[key] = (value, expires)
+            Domoticz.Debug('Restored {} spotify search results from cache'.format(len(self.entries)))
+        except (TypeError, ValueError) as error:
+            Domoticz.Error('Cannot restore search cache: {}'.format(str(error)))
+
+    def dump(self):
+        with self.lock:
+            return [[key, value, expires] for key, (value, expires) in self.entries.items()]
+
+
+class ResponseCache:
+    # Last parsed JSON body and its ETag per url, so a GET can be sent with If-None-Match and a 304 Not Modified
+    # reuses the parsed object without reading or parsing a body.
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"not_modified": 0, "stored": 0, "gone": 0}
+
+    def etag(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            return entry[0] if entry is not None else None
+
+    def reuse(self, url, etag):
+        # Returns whether the entry of etag is still there and its parsed object, after a 304 for this url. Another
+        # worker may have evicted or replaced it since the request was sent.
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None or entry[0] != etag:
+                self.counters["gone"] += 1
+                return False, None
+            self.entries.move_to_end(url)
+            self.counters["not_modified"] += 1
+            return True, entry[1]
+
+    def put(self, url, etag, parsed):
+        with self.lock:
+            if not etag:
+                self.entries.pop(url, None)
+                return None
+            self.entries[url] = (etag, parsed)
+            self.entries.move_to_end(url)
+            self.counters["stored"] += 1
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+        return stats
+
+
+#############################################################################
+#                      Polling                                              #
+#############################################################################
+class PollScheduler:
+    # Decides when the playback state is polled next. While playing it polls just after the current track ends, while
+    # idle it backs off exponentially and for a short while after a command it polls every few seconds.
+    def __init__(self, interval):
+        self.interval = interval
+        self.nextPoll = 0
+        self.delay = 0
+        self.idleCount = 0
+        self.boostUntil = 0
+        self.polls = collections.deque()
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        return self.interval > 0 and now >= self.nextPoll
+
+    def polling(self, now=None):
+        # provisional schedule, in case no result comes back
+        now = time.time() if now is None else now
+        self.polls.append(now)
+        self.nextPoll = now + self.interval
+
+    def update(self, code, resultJson, now=None):
+        now = time.time() if now is None else now
+        if code == 200 and resultJson and resultJson.get('is_playing'):
+            self.idleCount = 0
+            delay = self.interval
+            item = resultJson.get('item')
+            if item and item.get('duration_ms') and resultJson.get('progress_ms') is not None:
+                remaining = (item['duration_ms'] - resultJson['progress_ms']) / 1000.0
+                delay = min(delay, max(0, remaining) + POLL_TRACK_END_DELAY)
+        elif code in (200, 204):
+            delay = min(self.interval * 2 ** self.idleCount, max(self.interval, POLL_IDLE_MAX))
+            self.idleCount += 1
+        else:
+            delay = self.interval
+
+        if now < self.boostUntil:
+            delay = min(delay, POLL_BOOST_INTERVAL)
+        self.delay = delay
+        self.nextPoll = now + delay
+        return delay
+
+    def boost(self, now=None):
+        now = time.time() if now is None else now
+        self.idleCount = 0
+        self.boostUntil = now + POLL_BOOST_WINDOW
+        self.delay = min(self.delay or self.interval, POLL_BOOST_INTERVAL)
+        self.nextPoll = min(self.nextPoll, now + POLL_BOOST_INTERVAL)
+
+    def rate(self):
+        # polls per second at the current delay, the interval until the first result is in
+        if self.interval <= 0:
+            return 0
+        return 1.0 / max(1, self.delay or self.interval)
+
+    def pollsPerHour(self, now=None):
+        now = time.time() if now is None else now
+        while self.polls and self.polls[0] < now - 3600:
+            self.polls.popleft()
+        return len(self.polls)
+
+
+#############################################################################
+#                      Rate limiting                                        #
+#############################################################################
+class RateLimiter:
+    # Token bucket shared by all Spotify Web API calls. After a 429 no request is sent until Retry-After has passed.
+    # Polls never wait: they are dropped when no token is available or when they would eat into the tokens reserved
+    # for user commands.
+    def __init__(self, rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST, reserve=RATE_LIMIT_POLL_RESERVE):
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.blockedUntil = 0
+        self.lock = threading.Lock()
+        self.counters = {"throttled": 0, "dropped": 0, "retry_after": 0}
+
+    def acquire(self, priority=PRIORITY_COMMAND, maxwait=RATE_LIMIT_MAX_WAIT):
+        deadline = time.time() + maxwait
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                needed = 1 + (self.reserve if priority == PRIORITY_POLL else 0)
+                if now >= self.blockedUntil and self.tokens >= needed:
+                    self.tokens -= 1
+                    return True
+
+                if priority == PRIORITY_POLL:
+                    self.counters["dropped"] += 1
+                    return False
+
+                wait = max(self.blockedUntil - now, (1 - self.tokens) / self.rate)
+                if now + wait > deadline:
+                    self.counters["throttled"] += 1
+                    return False
+
+            time.sleep(wait)
+
+    def backoff(self, retryAfter):
+        try:
+            retryAfter = int(retryAfter)
+        except (TypeError, ValueError):
+            retryAfter = 1
+        with self.lock:
+            self.blockedUntil = max(self.blockedUntil, time.time() + retryAfter)
+            self.counters["retry_after"] += 1
+        return retryAfter
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["blocked"] = max(0, int(self.blockedUntil - time.time()))
+        return stats
+
+
+_rateLimiter = RateLimiter()
+
+
+#############################################################################
+#                      Metrics                                              #
+#############################################################################
+class LatencyHistogram:
+    # Fixed millisecond buckets, percentiles are reported as the upper bound of the bucket they fall in
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0
+        needed = pct / 100.0 * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= needed:
+                return METRICS_BUCKETS[index] if index < len(METRICS_BUCKETS) else round(self.max)
+        return round(self.max)
+
+    def summary(self):
+        return {"count": self.count,
+                "avg_ms": round(self.total / self.count, 1) if self.count else 0,
+                "p50_ms": self.percentile(50),
+                "p95_ms": self.percentile(95),
+                "p99_ms": self.percentile(99),
+                "max_ms": round(self.max, 1)}
+
+
+class Metrics:
+    # Call counts, error counts by status code and latency histograms per endpoint
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.latency = LatencyHistogram()
+
+    def record(self, endpoint, status, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {"calls": 0, "errors": {}, "latency": LatencyHistogram()}
+            stats["calls"] += 1
+            if status == 'error' or status >= 400:
+                stats["errors"][str(status)] = stats["errors"].get(str(status), 0) + 1
+            stats["latency"].add(ms)
+            self.latency.add(ms)
+
+    def summary(self):
+        with self.lock:
+            endpoints = dict((endpoint, {"calls": stats["calls"],
+                                         "errors": dict(stats["errors"]),
+                                         "latency": stats["latency"].summary()})
+                             for endpoint, stats in self.endpoints.items())
+            latency = self.latency.summary()
+        return {"uptime": int(time.time() - self.started),
+                "calls": latency["count"],
+                "errors": sum(sum(stats["errors"].values()) for stats in endpoints.values()),
+                "latency": latency,
+                "endpoints": endpoints}
+
+    def summaryLine(self):
+        summary = self.summary()
+        line = 'API calls: {calls}, errors: {errors}, latency p50/p95/p99: {p50}/{p95}/{p99} ms'.format(
+            calls=summary["calls"], errors=summary["errors"], p50=summary["latency"]["p50_ms"],
+            p95=summary["latency"]["p95_ms"], p99=summary["latency"]["p99_ms"])
+        if summary["endpoints"]:
+            slowest = max(summary["endpoints"].items(), key=lambda item: item[1]["latency"]["p95_ms"])
+            line += ', slowest: {endpoint} p95 {p95} ms'.format(endpoint=slowest[0],
+                                                               p95=slowest[1]["latency"]["p95_ms"])
+        return line
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return None
+        data = json.dumps(self.server.provider(), indent=2, sort_keys=True).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    # Serves the metrics as JSON on http://127.0.0.1:<port>/metrics
+    def __init__(self, port, provider):
+        self.server = http.server.HTTPServer(('127.0.0.1', port), MetricsHandler)
+        self.server.provider = provider
+        self.thread = threading.Thread(name='SpotifyMetrics', target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+_metrics = Metrics()
+
+
+#############################################################################
+#                      Token management                                     #
+#############################################################################
+class TimerWheel:
+    # A single thread for the timers of all accounts instead of a thread per threading.Timer. Callbacks run on the
+    # timer thread one after another, a cancelled timer stays in the heap until it comes up. The thread starts with
+    # the first timer. After stop() new timers are ignored until start(), so a task that finishes during onStop
+    # cannot bring the thread back.
+    def __init__(self):
+        self.heap = []
+        self.sequence = 0
+        self.stopped = False
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            self.stopped = False
+
+    def schedule(self, delay, func):
+        with self.condition:
+            self.sequence += 1
+            entry = [time.time() + delay, self.sequence, func]
+            if self.stopped:
+                return entry
+            heapq.heappush(self.heap, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(name='SpotifyTimers', target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self.condition:
+            entry[2] = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    while self.heap and self.heap[0][2] is None:
+                        heapq.heappop(self.heap)
+                    if self.heap and self.heap[0][0] <= time.time():
+                        break
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                if self.stopped:
+                    return None
+                due, sequence, func = heapq.heappop(self.heap)
+            try:
+                _profiler.call(func) if _profiler.enabled else func()
+            except Exception as err:
+                Domoticz.Error('Timer {task} failed: {error}'.format(task=func.__name__, error=str(err)))
+
+    def pending(self):
+        with self.condition:
+            return len([entry for entry in self.heap if entry[2] is not None])
+
+    def stop(self, timeout=5):
+        with self.condition:
+            self.stopped = True
+            self.heap = []
+            thread = self.thread
+            self.thread = None
+            self.condition.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+
+_timerWheel = TimerWheel()
+
+
+class TokenRefresher:
+    # Refreshes the access token in the background a safety margin before it expires. Concurrent refresh requests are
+    # collapsed into a single in-flight request, the other callers wait for its outcome.
+    def __init__(self, refresh, margin=TOKEN_REFRESH_MARGIN, wheel=_timerWheel):
+        self.refresh = refresh
+        self.margin = margin
+        self.wheel = wheel
+        self.lock = threading.Lock()
+        self.inflight = None
+        self.timer = None
+        self.counters = {"refreshes": 0, "joined": 0}
+
+    def refreshNow(self):
+        with self.lock:
+            event = self.inflight
+            leader = event is None
+            if leader:
+                event = self.inflight = threading.Event()
+                self.counters["refreshes"] += 1
+            else:
+                self.counters["joined"] += 1
+
+        if not leader:
+            event.wait(TOKEN_REFRESH_WAIT)
+            return None
+
+        try:
+            self.refresh()
+        finally:
+            with self.lock:
+                self.inflight = None
+            event.set()
+
+    def schedule(self, expiresAt):
+        self.cancel()
+        delay = max(0, expiresAt - self.margin - time.time())
+        Domoticz.Debug('Next spotify token refresh in {} seconds'.format(int(delay)))
+        self.timer = self.wheel.schedule(delay, self.refreshNow)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.wheel.cancel(self.timer)
+            self.timer = None
+
+
+#############################################################################
+#                      Domoticz user variables                              #
+#############################################################################
+class UserVariableStore:
+    # Domoticz user variables indexed by name. The full list is only downloaded when it is older than maxage, a
+    # single variable can be read fresh by its idx and updates are only sent for values that changed.
+    def __init__(self, maxage=USERVAR_REFRESH):
+        self.maxage = maxage
+        self.variables = {}
+        self.lastRefresh = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        variables = DomoticzAPI({'type': 'command', 'param': 'getuservariables'})
+        if not variables:
+            raise Exception("Cannot read the uservariable holding the persistent variables")
+
+        with self.lock:
+            self.variables = dict((item["Name"], item) for item in variables.get("result", []))
+            self.lastRefresh = time.time()
+
+    def get(self, name):
+        if time.time() - self.lastRefresh > self.maxage:
+            self.refresh()
+        return self.variables.get(name)
+
+    def read(self, name):
+        # Value of a single variable, straight from Domoticz
+        item = self.get(name)
+        if item is None:
+            return None
+
+        try:
+            variables = DomoticzAPI({'type': 'command', 'param': 'getuservariable', 'idx': item["idx"]})
+        except Exception:
+            variables = None
+        if not variables or not variables.get("result"):
+            # idx went stale, the variable was removed or recreated
+            self.refresh()
+            item = self.variables.get(name)
+            return item['Value'] if item is not None else None
+
+        with self.lock:
+            self.variables[name] = variables["result"][0]
+        return variables["result"][0]['Value']
+
+    def add(self, name, value):
+        DomoticzAPI({"type": "command", "param": "adduservariable", "vname": name, "vtype": "2", "vvalue": value})
+        # idx is only known after the next refresh
+        self.lastRefresh = 0
+
+    def update(self, name, value):
+        item = self.variables.get(name)
+        if item is not None and item['Value'] == value:
+            return False
+
+        DomoticzAPI({"type": "command", "param": "updateuservariable", "vname": name, "vtype": "2", "vvalue": value})
+        if item is not None:
+            with self.lock:
+                item = dict(item)
+                item['Value'] = value
+                self.variables[name] = item
+        return True
+
+    def delete(self, name):
+        item = self.get(name)
+        if item is None:
+            return False
+
+        DomoticzAPI({"type": "command", "param": "deleteuservariable", "idx": item["idx"]})
+        with self.lock:
+            self.variables.pop(name, None)
+        return True
+
+    def startingWith(self, prefix):
+        # Values of all variables whose name starts with prefix
+        if time.time() - self.lastRefresh > self.maxage:
+            self.refresh()
+        with self.lock:
+            return dict((name, item['Value']) for name, item in self.variables.items() if name.startswith(prefix))
+
+
+#############################################################################
+#                      Devices selector                                     #
+#############################################################################
+class SelectorIndex:
+    # Maps the levels of the devices selector to level names and spotify device ids and back. The name maps are only
+    # rebuilt when LevelNames changes, the device maps only when the list of spotify devices changes.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.levelNames = None
+        self.deviceKey = None
+        self.options = None
+        self.levelToName = {}
+        self.nameToLevel = {}
+        self.nameToDevice = {}
+        self.deviceToName = {}
+
+    def syncNames(self, strSelectorNames):
+        if strSelectorNames == self.levelNames:
+            return False
+
+        lstSelectorNames = strSelectorNames.split('|')
+        with self.lock:
+            self.levelToName = dict((str(level * 10), name) for level, name in enumerate(lstSelectorNames))
+            # the first level wins when a name is used twice
+            self.nameToLevel = dict((name, str(level * 10)) for level, name in reversed(list(
+                enumerate(lstSelectorNames))))
+            self.levelNames = strSelectorNames
+            self.options = None
+        return True
+
+    def build(self, strSelectorNames, spotDevices):
+        deviceKey = tuple((device['id'], device['name']) for device in spotDevices['devices'])
+        if deviceKey == self.deviceKey and strSelectorNames == self.levelNames and self.options is not None:
+            return self.options
+
+        self.syncNames(strSelectorNames)
+        with self.lock:
+            intLevels = len(self.levelToName)
+            strSelectorActions = '|' * (intLevels - 1)
+
+            for device in spotDevices['devices']:
+                if device['name'] not in self.nameToLevel:
+                    level = str(intLevels * 10)
+                    strSelectorNames += '|' + device['name']
+                    strSelectorActions += '|'
+                    self.levelToName[level] = device['name']
+                    self.nameToLevel[device['name']] = level
+                    intLevels += 1
+                self.nameToDevice[device['name']] = device['id']
+                self.deviceToName[device['id']] = device['name']
+
+            self.levelNames = strSelectorNames
+            self.deviceKey = deviceKey
+            self.options = {"LevelActions": strSelectorActions,
+                            "LevelNames": strSelectorNames,
+                            "LevelOffHidden": "false",
+                            "SelectorStyle": "1"}
+        return self.options
+
+    def learn(self, deviceName, deviceId):
+        # device seen in a playback state, no need to ask spotify for the device list
+        if deviceName in self.nameToDevice and self.nameToDevice[deviceName] == deviceId:
+            return None
+        with self.lock:
+            self.nameToDevice[deviceName] = deviceId
+            self.deviceToName[deviceId] = deviceName
+
+    def level(self, name):
+        return self.nameToLevel.get(name)
+
+    def name(self, level):
+        return self.levelToName.get(level)
+
+    def device(self, level):
+        return self.nameToDevice.get(self.levelToName.get(level))
+
+    def deviceLevel(self, deviceId):
+        return self.nameToLevel.get(self.deviceToName.get(deviceId))
+
+    def devices(self):
+        with self.lock:
+            return dict((self.nameToLevel[name], deviceId) for name, deviceId in self.nameToDevice.items()
+                        if name in self.nameToLevel)
+
+
+#############################################################################
+#                      Domoticz devices                                     #
+#############################################################################
+class DeviceWriter:
+    # Diff-and-coalesce layer in front of Device.Update, every update is a write to the Domoticz database. Unchanged
+    # values are skipped, a unit with a minimum interval is written at most once per interval: the latest value waits
+    # until flush() is called after the interval. Only used from the plugin thread.
+    def __init__(self):
+        self.intervals = {}
+        self.lastWrite = {}
+        self.pending = {}
+        self.counters = {"written": 0, "skipped": 0, "coalesced": 0}
+
+    def setInterval(self, unit, seconds):
+        self.intervals[unit] = seconds
+
+    def update(self, unit, nValue, sValue):
+        if unit not in Devices:
+            return False
+        if Devices[unit].nValue == nValue and Devices[unit].sValue == sValue:
+            self.pending.pop(unit, None)
+            self.counters["skipped"] += 1
+            return False
+        if time.time() - self.lastWrite.get(unit, 0) < self.intervals.get(unit, 0):
+            if unit in self.pending:
+                self.counters["coalesced"] += 1
+            self.pending[unit] = (nValue, sValue)
+            return False
+        self.write(unit, nValue, sValue)
+        return True
+
+    def write(self, unit, nValue, sValue):
+        Domoticz.Debug('Update for device {device_index} with nValue {device_value} and sValue {value_type}'.format(
+            device_index=unit, device_value=nValue, value_type=sValue))
+        self.pending.pop(unit, None)
+        self.lastWrite[unit] = time.time()
+        self.counters["written"] += 1
+        Devices[unit].Update(nValue, sValue)
+
+    def flush(self):
+        # Writes the pending values whose interval has passed
+        for unit, (nValue, sValue) in list(self.pending.items()):
+            if time.time() - self.lastWrite.get(unit, 0) >= self.intervals.get(unit, 0):
+                self.pending.pop(unit)
+                self.update(unit, nValue, sValue)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["pending"] = len(self.pending)
+        return stats
+
+
+#############################################################################
+#                      Long track lists                                     #
+#############################################################################
+class TrackPages:
+    # The rest of a long 'tracks' result after playback started with its first page. The later pages are fetched in
+    # the background and played with a second play request that holds all tracks and continues at the track and
+    # position that is playing. Nothing goes through the Spotify queue, which would outlive a later command. A newer
+    # command calls clear(), an extension that is still running then gives up before its play request.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.pending = False
+        self.counters = {"extended": 0, "dropped": 0, "tracks": 0}
+
+    def start(self):
+        with self.lock:
+            self.generation += 1
+            self.pending = True
+            return self.generation
+
+    def clear(self):
+        with self.lock:
+            if self.pending:
+                self.counters["dropped"] += 1
+            self.pending = False
+            self.generation += 1
+
+    def current(self, generation):
+        with self.lock:
+            return generation == self.generation
+
+    def done(self, generation, tracks=0):
+        with self.lock:
+            if generation == self.generation:
+                self.pending = False
+            if tracks:
+                self.counters["extended"] += 1
+                self.counters["tracks"] = tracks
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=self.pending)
+
+
+#############################################################################
+#                      Presets                                              #
+#############################################################################
+class PresetTable:
+    # Playback targets bound to selector level names. A preset is defined by the user variable [name]-preset-[level
+    # name], holding a search string or spotify uri optionally preceded by the device to play on: 'Kitchen|playlist
+    # Morning'. The targets are resolved in the background and kept on disk, so a preset only needs the play request.
+    def __init__(self, maxage=PRESET_REFRESH):
+        self.maxage = maxage
+        self.presets = {}
+        self.lock = threading.Lock()
+        self.counters = {"used": 0, "resolved": 0, "failed": 0}
+
+    @staticmethod
+    def parse(definition):
+        # Returns a (device name, search string or uri) tuple, device name is None when not given
+        device, separator, query = definition.partition('|')
+        if not separator:
+            return None, definition.strip()
+        return device.strip() or None, query.strip()
+
+    def outdated(self, definitions):
+        # Names of the presets that are new, changed or due for revalidation. Spotify uris never go stale.
+        now = time.time()
+        with self.lock:
+            names = []
+            for name, definition in definitions.items():
+                preset = self.presets.get(name)
+                if preset is None or preset["definition"] != definition or preset["target"] is None:
+                    names.append(name)
+                elif not self.parse(definition)[1].startswith('spotify:') and now - preset["resolved"] > self.maxage:
+                    names.append(name)
+            return names
+
+    def apply(self, definitions, resolved):
+        # definitions holds all defined presets, resolved the new targets. A failed revalidation keeps the old target.
+        # Returns True when the table changed.
+        with self.lock:
+            changed = bool(resolved)
+            for name in list(self.presets):
+                if name not in definitions:
+                    del self.presets[name]
+                    changed = True
+            for name, target in resolved.items():
+                if target is None:
+                    self.counters["failed"] += 1
+                    preset = self.presets.get(name)
+                    if preset is None or preset["definition"] != definitions[name]:
+                        self.presets[name] = {"definition": definitions[name], "target": None, "resolved": 0}
+                    continue
+                self.counters["resolved"] += 1
+                self.presets[name] = {"definition": definitions[name], "target": target, "resolved": time.time()}
+            return changed
+
+    def get(self, name):
+        # Returns a (device name, target) tuple, or None when there is no resolved preset for this level name
+        with self.lock:
+            preset = self.presets.get(name)
+            if preset is None or preset["target"] is None:
+                return None
+            self.counters["used"] += 1
+            return self.parse(preset["definition"])[0], preset["target"]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.presets)
+        return stats
+
+    def restore(self, presets):
+        try:
+            with self.lock:
+                self.presets = dict((name, preset) for name, preset in presets.items()
+                                    if {"definition", "target", "resolved"} <= set(preset))
+            Domoticz.Debug('Restored {} presets'.format(len(self.presets)))
+        except (AttributeError, TypeError) as error:
+            Domoticz.Error('Cannot restore presets: {}'.format(str(error)))
+
+    def dump(self):
+        with self.lock:
+            return dict(self.presets)
+
+
+#############################################################################
+#                      Plugin state                                         #
+#############################################################################
+class StateStore:
+    # Plugin state in a single JSON file in the plugin folder: tokens, spotify devices, search results and presets.
+    # Every save writes all sections in one go to a temporary file that is fsynced and renamed over the old one. The
+    # file holds the tokens, so it is only readable by the user running Domoticz.
+    def __init__(self, path=None):
+        self.path = path
+        self.state = {}
+        self.lock = threading.Lock()
+        self.counters = {"writes": 0}
+
+    def migrate(self, legacyPath):
+        # Domoticz gives every hardware instance the same folder, a state file without the hardware id is taken over
+        # once by the first instance that starts
+        if not self.path or os.path.exists(self.path) or not os.path.isfile(legacyPath):
+            return False
+        try:
+            os.replace(legacyPath, self.path)
+        except OSError as error:
+            Domoticz.Error('Cannot move {old} to {new}: {error}'.format(old=legacyPath, new=self.path,
+                                                                      error=str(error)))
+            return False
+        Domoticz.Log('Moved {old} to {new}, delete it if it belongs to another hardware instance'.format(
+            old=os.path.basename(legacyPath), new=os.path.basename(self.path)))
+        return True
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path) as stateFile:
+                state = json.load(stateFile)
+            if not isinstance(state, dict):
+                raise ValueError('expected a JSON object')
+        except (OSError, ValueError) as error:
+            Domoticz.Error('Cannot read {file}: {error}'.format(file=self.path, error=str(error)))
+            return False
+        with self.lock:
+            self.state = state
+        return True
+
+    def get(self, section, default=None):
+        with self.lock:
+            return self.state.get(section, default)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.state)
+
+    def save(self, **sections):
+        with self.lock:
+            self.state.update(sections)
+            if not self.path:
+                return False
+            try:
+                fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as stateFile:
+                    json.dump(self.state, stateFile)
+                    stateFile.flush()
+                    os.fsync(stateFile.fileno())
+                os.replace(self.path + '.tmp', self.path)
+                self.counters["writes"] += 1
+                return True
+            except OSError as error:
+                Domoticz.Error('Cannot write {file}: {error}'.format(file=self.path, error=str(error)))
+                return False
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+#############################################################################
+#                      Profiling                                            #
+#############################################################################
+class Profiler:
+    # Opt-in profiling of the Domoticz callbacks, the worker tasks and the timers. The first and then every sample-th
+    # call of each function runs under cProfile, the sampled calls are aggregated and every interval written to
+    # <home>/spotify_profile.pstats, the older reports are rotated to .1 to .<keep>. One call is profiled at a time,
+    # a call that comes up while another thread is being profiled runs unprofiled. Reports are only written from the
+    # thread that started the profiler. With traceMemory tracemalloc runs as well and an allocation report is written
+    # next to it. While disabled the callers only check the enabled attribute.
+    def __init__(self, sample=PROFILE_SAMPLE, interval=PROFILE_INTERVAL, top=PROFILE_TOP, keep=PROFILE_KEEP):
+        self.enabled = False
+        self.sample = sample
+        self.interval = interval
+        self.top = top
+        self.keep = keep
+        self.folder = None
+        self.traceMemory = False
+        self.calls = {}
+        self.sampled = {}
+        self.aggregate = None
+        self.snapshot = None
+        self.nextReport = 0
+        self.owner = None
+        self.lock = threading.Lock()
+        self.active = threading.Lock()
+        self.counters = {"reports": 0, "busy": 0}
+
+    def start(self, folder, sample=None, traceMemory=False):
+        if self.enabled:
+            return None
+        self.folder = folder
+        self.sample = max(1, sample or self.sample)
+        self.traceMemory = traceMemory
+        if traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.nextReport = time.time() + self.interval
+        self.owner = threading.current_thread()
+        self.enabled = True
+        Domoticz.Log('Profiling 1 in {sample} callbacks{memory}, reports in {folder}'.format(
+            sample=self.sample, memory=' and memory allocations' if traceMemory else '', folder=folder))
+
+    def call(self, func, *args):
+        name = func.__name__
+        with self.lock:
+            count = self.calls[name] = self.calls.get(name, 0) + 1
+        if (count - 1) % self.sample:
+            return self.finish(func(*args))
+        if not self.active.acquire(False):
+            # newer Pythons allow only one active cProfile, and one at a time keeps the threads out of each other's
+            # samples
+            with self.lock:
+                self.counters["busy"] += 1
+            return self.finish(func(*args))
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self.active.release()
+            self.add(name, profile)
+            self.finish(None)
+
+    def finish(self, result):
+        if time.time() >= self.nextReport and threading.current_thread() is self.owner:
+            self.report()
+        return result
+
+    def add(self, name, profile):
+        with self.lock:
+            self.sampled[name] = self.sampled.get(name, 0) + 1
+            if self.aggregate is None:
+                self.aggregate = pstats.Stats(profile)
+            else:
+                self.aggregate.add(profile)
+
+    def report(self):
+        self.nextReport = time.time() + self.interval
+        with self.lock:
+            aggregate, sampled = self.aggregate, self.sampled
+            self.aggregate = None
+            self.sampled = {}
+        if aggregate is not None:
+            path = self.rotate(PROFILE_FILE, '.pstats')
+            aggregate.dump_stats(path)
+            Domoticz.Log('Profile of {calls} written to {path}, top {top} by own time:'.format(
+                calls=', '.join('{} {}x'.format(name, count) for name, count in sorted(sampled.items())),
+                path=path, top=self.top))
+            for line in self.hotFunctions(aggregate):
+                Domoticz.Log(line)
+        if self.traceMemory and tracemalloc.is_tracing():
+            self.reportMemory()
+        self.counters["reports"] += 1
+
+    def hotFunctions(self, aggregate):
+        entries = sorted(aggregate.stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+        for (filename, line, function), (primitive, calls, own, cumulative, callers) in entries:
+            template = '{own:8.1f} ms own {cumulative:8.1f} ms cumulative {calls:6} calls  {function} ({file}:{line})'
+            yield template.format(
+                own=own * 1000, cumulative=cumulative * 1000, calls=calls, function=function,
+                file=os.path.basename(filename), line=line)
+
+    def reportMemory(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+        current, peak = tracemalloc.get_traced_memory()
+        path = self.rotate(PROFILE_FILE, '.alloc.txt')
+        try:
+            with open(path, 'w') as report:
+                report.write('Traced memory {current} KiB, peak {peak} KiB\n\nTop allocations:\n'.format(
+                    current=current // 1024, peak=peak // 1024))
+                for statistic in snapshot.statistics('lineno')[:self.top]:
+                    report.write('{}\n'.format(statistic))
+                if self.snapshot is not None:
+                    report.write('\nGrowth since the last report:\n')
+                    for statistic in snapshot.compare_to(self.snapshot, 'lineno')[:self.top]:
+                        report.write('{}\n'.format(statistic))
+        except OSError as error:
+            Domoticz.Error('Cannot write {file}: {error}'.format(file=path, error=str(error)))
+        self.snapshot = snapshot
+        Domoticz.Log('Traced memory {current} KiB, peak {peak} KiB, allocation report written to {path}'.format(
+            current=current // 1024, peak=peak // 1024, path=path))
+
+    def rotate(self, name, suffix):
+        # <name><suffix> is the newest report, <name>.1<suffix> the one before it and so on
+        path = os.path.join(self.folder, name)
+        for number in range(self.keep, 0, -1):
+            older = '{}.{}{}'.format(path, number - 1, suffix) if number > 1 else path + suffix
+            if os.path.isfile(older):
+                try:
+                    os.replace(older, '{}.{}{}'.format(path, number, suffix))
+                except OSError as error:
+                    Domoticz.Error('Cannot rotate {file}: {error}'.format(file=older, error=str(error)))
+        return path + suffix
+
+    def stop(self):
+        if not self.enabled:
+            return None
+        self.report()
+        self.enabled = False
+        if self.traceMemory:
+            tracemalloc.stop()
+            self.snapshot = None
+
+    def stats(self):
+        with self.lock:
+            return {"enabled": self.enabled,
+                    "sample": self.sample,
+                    "calls": dict(self.calls),
+                    "reports": self.counters["reports"],
+                    "busy": self.counters["busy"]}
+
+
+_profiler = Profiler()
 
 
 #############################################################################
 #                      Domoticz call back functions                         #
 #############################################################################
 class BasePlugin:
-    def __init__(self):
+    # account is None for the account of the hardware parameters, which is the hub for the extra accounts. The extra
+    # accounts share its workers, transport, caches, state file and device writer, and have their own tokens, units
+    # (index * ACCOUNT_UNITS onwards) and poll schedule.
+    def __init__(self, account=None, hub=None, index=0):
+        self.account = account
+        self.hub = hub
+        self.unitBase = index * ACCOUNT_UNITS
+        self.accounts = {}
         self.spotifyToken = {"access_token": "",
                              "refresh_token": "",
                              "retrievaldate": ""
                              }
         self.spotifySearchParam = ["searchTxt"]
-        self.tokenexpired = 3600
-        self.spotArrDevices = {}
-        self.spotifyAccountUrl = "https://accounts.spotify.com/api/token"
-        self.spotifyApiUrl = "https://api.spotify.com/v1"
-        self.heartbeatCounterPoll = 1
+        self.tokenexpired = TOKEN_LIFETIME
+        self.tokenRefresher = TokenRefresher(self.spotGetRefreshToken)
+        self.selectorIndex = SelectorIndex()
+        self.nextDeviceRefresh = 0
+        self.presets = PresetTable()
+        self.trackPages = TrackPages()
+        self.nextPresetRefresh = 0
+        self.legacyTokenVars = False
+        self.startup = {}
+        self.spotifyOptions = {"metricsPort": "", "metricsDevices": "", "market": "", "exportTokens": "",
+                               "accounts": "", "profile": "", "profileMemory": "",
+                               "queueMax": ""}
+        self.responseCache = ResponseCache()
+        self.knownSpotDevices = None
+        self.pollScheduler = PollScheduler(0)
         self.blError = False
+        self.metricsServer = None
+        if hub is None:
+            self.rateLimiter = _rateLimiter
+            self.deviceWriter = DeviceWriter()
+            self.state = StateStore()
+            self.spotifyAccountUrl = "https://accounts.spotify.com/api/token"
+            self.spotifyApiUrl = "https://api.spotify.com/v1"
+            self.metrics = _metrics
+            self.nextMetricsReport = time.time() + METRICS_INTERVAL
+            self.transport = HttpConnectionPool(metrics=self.metrics)
+            self.engine = WorkerEngine()
+            self.searchCache = SearchCache()
+            self.userVars = UserVariableStore()
+        else:
+            self.rateLimiter = hub.rateLimiter
+            self.deviceWriter = hub.deviceWriter
+            self.state = hub.state
+            self.spotifyAccountUrl = hub.spotifyAccountUrl
+            self.spotifyApiUrl = hub.spotifyApiUrl
+            self.metrics = hub.metrics
+            self.transport = hub.transport
+            self.engine = hub.engine
+            self.searchCache = hub.searchCache
+            self.userVars = hub.userVars
+        self.commands = CommandPipeline(self.engine)
+        self.volumeCommands = CommandPipeline(self.engine)
+        self.playModeCommands = CommandPipeline(self.engine)
+        self.controlPending = {}
+        self.lastPlayback = (0, None)
+        self.deviceWriter.setInterval(self.unit(NOWPROGRESS), PROGRESS_UPDATE_INTERVAL)
+
+    def unit(self, unit):
+        return self.unitBase + unit
+
+    def varName(self, name):
+        # [name]-[setting] for the account of the hardware parameters, [name]-[account]-[setting] for the others
+        if self.account is None:
+            return Parameters["Name"] + '-' + name
+        return '{}-{}-{}'.format(Parameters["Name"], self.account, name)
+
+    def deviceName(self, name):
+        if self.account is None:
+            return name
+        return '{} {}'.format(self.account, name)
 
     def onStart(self):
+        self.startup["started"] = time.time()
         if Parameters["Mode6"] == "Debug":
             Domoticz.Debugging(1)
 
@@ -84,144 +1674,479 @@ class BasePlugin:
                 self.blError = True
                 return None
 
-        if not self.getUserVar():
-            self.blError = True
-            return None
+        # beat fast until the background bootstrap is done, so its results are applied right away
+        Domoticz.Heartbeat(STARTUP_HEARTBEAT)
+
+        self.engine.start()
+        _timerWheel.start()
+        self.pollScheduler.interval = int(Parameters["Mode5"]) * POLL_UNIT
+
+        self.state.path = os.path.join(Parameters["HomeFolder"], STATE_FILE.format(Parameters["HardwareID"]))
+        self.state.migrate(os.path.join(Parameters["HomeFolder"], LEGACY_STATE_FILE))
+        if self.loadState():
+            Domoticz.Log('Restored spotify token and devices from last run')
+            self.tokenRefresher.schedule(float(self.spotifyToken['retrievaldate']) + self.tokenexpired)
+        self.startBootstrap()
+        self.startup["onStart"] = time.time() - self.startup["started"]
+        Domoticz.Debug('onStart done in {} ms'.format(int(self.startup["onStart"] * 1000)))
+
+    def startAccount(self, offset):
+        # onStart of an extra account, the hub has started the shared parts
+        self.startup["started"] = time.time()
+        self.pollScheduler.interval = self.hub.pollScheduler.interval
+        self.pollScheduler.nextPoll = time.time() + offset
+        if self.loadState():
+            Domoticz.Log('Restored spotify token and devices of account {}'.format(self.account))
+            self.tokenRefresher.schedule(float(self.spotifyToken['retrievaldate']) + self.tokenexpired)
+        self.startBootstrap()
+        self.startup["onStart"] = time.time() - self.startup["started"]
+
+    def startBootstrap(self):
+        if self.unit(SPOTIFYDEVICES) in Devices:
+            self.selectorIndex.syncNames(Devices[self.unit(SPOTIFYDEVICES)].Options['LevelNames'])
+
+        # user variables and spotify devices are fetched concurrently, the devices as soon as there is a token
+        self.startup["pending"] = set(['tokens', 'devices'])
+        self.engine.submit(self.bootstrapTokens, callback=self.onBootstrapTokens)
+        if self.hasToken():
+            self.engine.submit(self.spotDevices, callback=self.onBootstrapDevices)
+            self.startup["devicesRequested"] = True
+
+    def hasToken(self):
+        return bool(self.spotifyToken['access_token'] and self.spotifyToken['refresh_token'] and
+                    self.spotifyToken['retrievaldate'])
+
+    def bootstrapTokens(self):
+        # Runs on a worker thread
+        try:
+            if not self.getUserVar():
+                return False
 
-        for key, value in self.spotifyToken.items():
-            if value == '':
+            if not self.hasToken():
                 Domoticz.Log("Not all spotify token variables are available, let's get it")
                 if not self.spotAuthoriseCode():
-                    self.blError = True
-                    return None
-                break
+                    return False
+            return True
 
-        self.checkDevices()
+        except Exception as error:
+            Domoticz.Error(str(error))
+            return False
 
-        Domoticz.Heartbeat(30)
+    def onBootstrapTokens(self, result):
+        if not result:
+            self.blError = True
+            if self.hub is None:
+                Domoticz.Heartbeat(HEARTBEAT_INTERVAL)
+            return None
 
-    def checkDevices(self):
+        self.tokenRefresher.schedule(float(self.spotifyToken['retrievaldate']) + self.tokenexpired)
+        if self.hub is None:
+            self.startMetrics()
+            self.startProfiling()
+            self.syncAccounts()
+        self.nextPresetRefresh = time.time() + USERVAR_REFRESH
+        self.engine.submit(self.refreshPresets, callback=self.onPresetsRefreshed)
+        if self.legacyTokenVars:
+            self.legacyTokenVars = False
+            self.engine.submit(self.removeTokenVars)
+        if not self.startup.get("devicesRequested"):
+            self.engine.submit(self.spotDevices, callback=self.onBootstrapDevices)
+            self.startup["devicesRequested"] = True
+        self.bootstrapDone('tokens')
+
+    def onBootstrapDevices(self, spotDevices):
+        if spotDevices is None:
+            # spotify could not be reached, carry on with the restored devices and let the background refresh retry
+            # on the next heartbeat, a callback must not fetch on the plugin thread
+            spotDevices = self.knownSpotDevices or {'devices': []}
+            self.nextDeviceRefresh = time.time()
+        else:
+            self.knownSpotDevices = spotDevices
+            self.nextDeviceRefresh = time.time() + DEVICE_REFRESH
+        self.checkDevices(spotDevices)
+        self.saveState()
+        self.bootstrapDone('devices')
+
+    def removeTokenVars(self):
+        Domoticz.Log('Removing the spotify token user variables, set {} to 1 to keep them'.format(
+            self.varName('exportTokens')))
+        for intVar in self.spotifyToken:
+            self.userVars.delete(self.varName(intVar))
+
+    def bootstrapDone(self, step):
+        self.startup["pending"].discard(step)
+        if not self.startup["pending"]:
+            self.startup["ready"] = time.time() - self.startup["started"]
+            if self.hub is None:
+                Domoticz.Heartbeat(HEARTBEAT_INTERVAL)
+                Domoticz.Log('Spotify plugin ready in {ready} ms (onStart {onStart} ms)'.format(
+                    ready=int(self.startup["ready"] * 1000), onStart=int(self.startup["onStart"] * 1000)))
+            else:
+                Domoticz.Log('Spotify account {account} ready in {ready} ms'.format(
+                    account=self.account, ready=int(self.startup["ready"] * 1000)))
+
+    def syncAccounts(self):
+        # Starts the extra accounts of the [name]-accounts option. An account keeps the units it got the first time.
+        names = [name.strip() for name in self.spotifyOptions["accounts"].split(',') if name.strip()]
+        indexes = dict(self.state.get('accounts') or {})
+        for name in names:
+            if name in self.accounts:
+                continue
+            index = indexes.get(name)
+            if index is None:
+                index = max(list(indexes.values()) + [0]) + 1
+            if index >= MAX_ACCOUNTS:
+                Domoticz.Error('Account {name} not started, at most {max} accounts are supported'.format(
+                    name=name, max=MAX_ACCOUNTS - 1))
+                continue
+            indexes[name] = index
+            self.accounts[name] = BasePlugin(name, self, index)
+
+        # spread the first polls of the accounts over the poll interval
+        for position, account in enumerate(self.accounts.values()):
+            if not account.startup:
+                account.startAccount(self.pollScheduler.interval * (position + 1) / (len(self.accounts) + 1))
+        self.engine.workers = min(WORKER_THREADS_MAX, WORKER_THREADS + len(self.accounts) // ACCOUNTS_PER_WORKER)
+        self.engine.start()
+        if indexes != (self.state.get('accounts') or {}):
+            self.state.save(accounts=indexes)
+
+    def allAccounts(self):
+        return [self] + list(self.accounts.values())
+
+    def accountForUnit(self, Unit):
+        for account in self.allAccounts():
+            if account.unitBase < Unit <= account.unitBase + ACCOUNT_UNITS:
+                return account
+        return None
+
+    def accountState(self):
+        # the hub keeps its state at the top level of the state file, an extra account in its own section
+        if self.hub is None:
+            return self.state.snapshot()
+        return self.state.get('account-' + self.account) or {}
+
+    def loadState(self):
+        if self.hub is None and not self.state.load():
+            return False
+        accountState = self.accountState()
+        try:
+            for intVar in self.spotifyToken:
+                if accountState.get('token', {}).get(intVar):
+                    self.spotifyToken[intVar] = accountState['token'][intVar]
+            self.tokenexpired = int(accountState.get('tokenexpired', TOKEN_LIFETIME))
+            for deviceName, deviceId in accountState.get('devices', {}).items():
+                self.selectorIndex.learn(deviceName, deviceId)
+        except (ValueError, AttributeError) as error:
+            Domoticz.Error('Cannot restore state from {file}: {error}'.format(file=self.state.path, error=str(error)))
+            return False
+        if self.hub is None:
+            self.searchCache.restore(accountState.get('search_cache', []))
+        self.presets.restore(accountState.get('presets', {}))
+        return self.hasToken()
+
+    def saveState(self):
+        # one write for everything, the sections are cheap to collect
+        accountState = {'token': dict(self.spotifyToken),
+                        'tokenexpired': self.tokenexpired,
+                        'devices': dict(self.selectorIndex.nameToDevice),
+                        'presets': self.presets.dump()}
+        if self.hub is None:
+            return self.state.save(search_cache=self.searchCache.dump(), **accountState)
+        return self.state.save(**{'account-' + self.account: accountState})
+
+    def onStop(self):
+        Domoticz.Debug('Stopping background workers')
+        for account in self.allAccounts():
+            account.tokenRefresher.cancel()
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+        # the workers first, a task that is still running may schedule a timer
+        self.engine.stop()
+        _timerWheel.stop()
+        self.transport.close()
+        _domoticzTransport.close()
+        for account in self.accounts.values():
+            account.saveState()
+        self.saveState()
+        _profiler.stop()
+
+    def startMetrics(self):
+        if self.spotifyOptions["metricsDevices"].lower() in ('1', 'true', 'yes', 'on'):
+            for unit, name in ((METRICSCALLS, "API calls"), (METRICSERRORS, "API errors"),
+                               (METRICSLATENCY, "API latency p95")):
+                if unit not in Devices:
+                    options = {"Custom": "1;ms"} if unit == METRICSLATENCY else {"Custom": "1;calls"}
+                    Domoticz.Device(Name=name, Unit=unit, TypeName="Custom", Options=options, Used=1).Create()
+
+        if self.spotifyOptions["metricsPort"]:
+            try:
+                self.metricsServer = MetricsServer(int(self.spotifyOptions["metricsPort"]), self.metricsSnapshot)
+                self.metricsServer.start()
+                Domoticz.Log('Serving metrics on http://127.0.0.1:{}/metrics'.format(
+                    self.spotifyOptions["metricsPort"]))
+            except (OSError, ValueError) as error:
+                Domoticz.Error('Cannot start metrics endpoint: {}'.format(str(error)))
+
+    def startProfiling(self):
+        # [name]-profile holds the sample rate, 1 profiles every callback
+        if not self.spotifyOptions["profile"] or _profiler.enabled:
+            return None
+        try:
+            sample = int(self.spotifyOptions["profile"])
+        except ValueError:
+            Domoticz.Error('Invalid profile sample rate {}'.format(self.spotifyOptions["profile"]))
+            return None
+        if sample > 0:
+            _profiler.start(Parameters["HomeFolder"], sample,
+                            self.spotifyOptions["profileMemory"].lower() in ('1', 'true', 'yes', 'on'))
+
+    def metricsSnapshot(self):
+        snapshot = self.metrics.summary()
+        snapshot.update({"transport": self.transport.stats(),
+                         "domoticz_transport": _domoticzTransport.stats(),
+                         "rate_limiter": self.rateLimiter.stats(),
+                         "search_cache": self.searchCache.stats(),
+                         "response_cache": self.responseCache.stats(),
+                         "presets": self.presets.stats(),
+                         "state_store": self.state.stats(),
+                         "device_writes": self.deviceWriter.stats(),
+                         "commands": self.commands.stats(),
+                         "tracks": self.trackPages.stats(),
+                         "token_refresher": dict(self.tokenRefresher.counters),
+                         "polls_per_hour": self.pollScheduler.pollsPerHour(),
+                         "timers": _timerWheel.pending(),
+                         "profiler": _profiler.stats(),
+                         "accounts": dict((name, {"polls_per_hour": account.pollScheduler.pollsPerHour(),
+                                                  "token_refresher": dict(account.tokenRefresher.counters),
+                                                  "error": account.blError})
+                                          for name, account in self.accounts.items()),
+                         "startup": {"onStart_ms": int(self.startup.get("onStart", 0) * 1000),
+                                     "ready_ms": int(self.startup.get("ready", 0) * 1000)}})
+        return snapshot
+
+    def reportMetrics(self):
+        Domoticz.Log(self.metrics.summaryLine())
+        summary = self.metrics.summary()
+        for unit, value in ((METRICSCALLS, summary["calls"]), (METRICSERRORS, summary["errors"]),
+                            (METRICSLATENCY, summary["latency"]["p95_ms"])):
+            if unit in Devices:
+                self.updateDomoticzDevice(unit, 0, str(value))
+
+    def checkDevices(self, spotDevices=None):
         Domoticz.Log("Checking if devices exist")
 
-        if SPOTIFYDEVICES not in Devices:
+        if self.unit(SPOTIFYDEVICES) not in Devices:
             Domoticz.Log("Spotify devices selector does not exist, creating device")
 
             strSelectorNames = 'Off'
-            dictOptions = self.buildDeviceSelector(strSelectorNames)
+            dictOptions = self.buildDeviceSelector(strSelectorNames, spotDevices)
 
-            Domoticz.Device(Name="devices", Unit=SPOTIFYDEVICES, Used=1, TypeName="Selector Switch", Switchtype=18,
-                            Options=dictOptions, Image=8).Create()
+            Domoticz.Device(Name=self.deviceName("devices"), Unit=self.unit(SPOTIFYDEVICES), Used=1,
+                            TypeName="Selector Switch", Switchtype=18, Options=dictOptions, Image=8).Create()
         else:
-            self.updateDeviceSelector()
-
-    def updateDeviceSelector(self):
+            self.updateDeviceSelector(spotDevices)
+
+        for unit, name, typeName in ((NOWTRACK, "track", "Text"), (NOWARTIST, "artist", "Text"),
+                                     (NOWALBUM, "album", "Text"), (NOWVOLUME, "volume", "Percentage"),
+                                     (NOWPROGRESS, "progress", "Percentage")):
+            if self.unit(unit) not in Devices:
+                Domoticz.Log("Now playing device {} does not exist, creating device".format(self.deviceName(name)))
+                Domoticz.Device(Name=self.deviceName(name), Unit=self.unit(unit), TypeName=typeName, Used=1).Create()
+
+        for unit, name, levelNames in ((CONTROLS, "controls", "Off|Previous|Back|Forward|Next"),
+                                       (PLAYMODE, "play mode", "Off|Shuffle|Repeat|Shuffle and repeat|Repeat track")):
+            if self.unit(unit) not in Devices:
+                Domoticz.Log("Control device {} does not exist, creating device".format(self.deviceName(name)))
+                dictOptions = {"LevelActions": "|" * levelNames.count('|'),
+                               "LevelNames": levelNames,
+                               "LevelOffHidden": "true" if unit == CONTROLS else "false",
+                               "SelectorStyle": "0"}
+                Domoticz.Device(Name=self.deviceName(name), Unit=self.unit(unit), TypeName="Selector Switch",
+                                Switchtype=18, Options=dictOptions, Image=8, Used=1).Create()
+        if self.unit(VOLUME) not in Devices:
+            Domoticz.Log("Control device {} does not exist, creating device".format(self.deviceName("volume control")))
+            Domoticz.Device(Name=self.deviceName("volume control"), Unit=self.unit(VOLUME), Type=244, Subtype=73,
+                            Switchtype=7, Image=8, Used=1).Create()
+
+    def updateDeviceSelector(self, spotDevices=None):
         Domoticz.Debug("Updating spotify devices selector")
-        strSelectorNames = Devices[SPOTIFYDEVICES].Options['LevelNames']
-        dictOptions = self.buildDeviceSelector(strSelectorNames)
-
-        if dictOptions != Devices[SPOTIFYDEVICES].Options:
-            Devices[SPOTIFYDEVICES].Update(nValue=Devices[SPOTIFYDEVICES].nValue, sValue=Devices[SPOTIFYDEVICES].sValue,
-                                           Options=dictOptions)
-
-    def buildDeviceSelector(self, strSelectorNames):
-        spotDevices = self.spotDevices()
+        strSelectorNames = Devices[self.unit(SPOTIFYDEVICES)].Options['LevelNames']
+        dictOptions = self.buildDeviceSelector(strSelectorNames, spotDevices)
+        self.applyDeviceSelector(dictOptions)
+
+    def applyDeviceSelector(self, dictOptions):
+        selector = Devices[self.unit(SPOTIFYDEVICES)]
+        if dictOptions != selector.Options:
+            selector.Update(nValue=selector.nValue, sValue=selector.sValue, Options=dictOptions)
+
+    def buildDeviceSelector(self, strSelectorNames, spotDevices=None):
+        # only a worker thread may leave spotDevices out, the callbacks pass what they got
+        if spotDevices is None:
+            spotDevices = self.spotDevices()
         Domoticz.Debug('JSON Returned from spotify listed available devices: ' + str(spotDevices))
+        if spotDevices is None:
+            spotDevices = {'devices': []}
 
-        strSelectorActions = ''
-
-        lstSelectorNames = strSelectorNames.split("|")
-
-        x = 1
-        while x < len(lstSelectorNames):
-            strSelectorActions += '|'
-            x += 1
-
-        intCounter = (len(lstSelectorNames) * 10)
-
-        for device in spotDevices['devices']:
-            if device['name'] not in lstSelectorNames:
-                strSelectorNames += '|' + device['name']
-                strSelectorActions += '|'
-                self.spotArrDevices.update({str(intCounter): device['id']})
-                intCounter += 10
-            else:
-                self.spotArrDevices.update({str(lstSelectorNames.index(device['name']) * 10): device['id']})
-
-        Domoticz.Debug('Local array listing selector level with device ids: ' + str(self.spotArrDevices))
-
-        dictOptions = {"LevelActions": strSelectorActions,
-                       "LevelNames": strSelectorNames,
-                       "LevelOffHidden": "false",
-                       "SelectorStyle": "1"}
+        dictOptions = self.selectorIndex.build(strSelectorNames, spotDevices)
+        Domoticz.Debug('Local array listing selector level with device ids: ' + str(self.selectorIndex.devices()))
 
         return dictOptions
 
+    def catchDeviceSelectorLvl(self, name):
+        self.selectorIndex.syncNames(Devices[self.unit(SPOTIFYDEVICES)].Options['LevelNames'])
+        lstSelectorLevel = self.selectorIndex.level(name)
+        if lstSelectorLevel is None:
+            raise ValueError('{} is not in the devices selector'.format(name))
+        return lstSelectorLevel
+
     def spotGetBearerHeader(self):
+        # Normally the token is refreshed in the background before it expires, this only catches a missed refresh
         tokenSecElapsed = time.time() - float(self.spotifyToken['retrievaldate'])
         if tokenSecElapsed > self.tokenexpired:
             Domoticz.Log('Token expired, getting new one using refresh_token')
-            self.spotGetRefreshToken()
+            self.tokenRefresher.refreshNow()
 
         return {"Authorization": "Bearer " + self.spotifyToken['access_token']}
 
-    def spotDevices(self):
-        try:
-            url = self.spotifyApiUrl + '/me/player/devices'
-            headers = self.spotGetBearerHeader()
+    def spotUrlopen(self, req, priority=PRIORITY_COMMAND):
+        retried = False
+        while True:
+            if not self.rateLimiter.acquire(priority):
+                Domoticz.Debug('Spotify request {url} throttled: {stats}'.format(
+                    url=req.full_url, stats=self.rateLimiter.stats()))
+                raise urllib.error.HTTPError(url=req.full_url, msg='Throttled', hdrs={}, fp=None, code=429)
 
-            req = urllib.request.Request(url, headers=headers)
-            response = urllib.request.urlopen(req)
+            try:
+                return self.transport.urlopen(req)
+            except urllib.error.HTTPError as err:
+                if retried or err.code not in (401, 429):
+                    raise
+                retried = True
+
+                if err.code == 429:
+                    retryAfter = self.rateLimiter.backoff(err.headers.get('Retry-After'))
+                    Domoticz.Log('Spotify rate limit reached, pausing requests for {seconds} seconds: {stats}'.format(
+                        seconds=retryAfter, stats=self.rateLimiter.stats()))
+                    if priority == PRIORITY_POLL:
+                        raise
+                    continue
+
+                # Token was revoked or expired early, refresh once unless another request already did
+                if req.get_header('Authorization') == 'Bearer ' + self.spotifyToken['access_token']:
+                    Domoticz.Log('Spotify rejected the access token, getting new one using refresh_token')
+                    self.tokenRefresher.refreshNow()
+                req.add_header('Authorization', 'Bearer ' + self.spotifyToken['access_token'])
+
+    def spotGetJson(self, url, priority=PRIORITY_COMMAND, conditional=True):
+        # GET with If-None-Match, returns the http code and the parsed body. On 304 Not Modified the object parsed
+        # from the last 200 response is returned with code 200, it is the very same object. One-off requests like
+        # pages of a long result pass conditional=False, so they do not push the polled responses out of the cache.
+        req = urllib.request.Request(url, headers=self.spotGetBearerHeader())
+        etag = self.responseCache.etag(url) if conditional else None
+        if etag:
+            req.add_header('If-None-Match', etag)
+        response = self.spotUrlopen(req, priority)
+
+        if response.status == 304 and etag:
+            found, parsed = self.responseCache.reuse(url, etag)
+            if found:
+                return 200, parsed
+            # the cached body went away in the meantime, ask for it again
+            response = self.spotUrlopen(urllib.request.Request(url, headers=self.spotGetBearerHeader()), priority)
+
+        strResponse = response.read().decode('utf-8')
+        parsed = json.loads(strResponse) if strResponse else None
+        if response.status == 200 and conditional:
+            self.responseCache.put(url, response.getheader('ETag'), parsed)
+        return response.status, parsed
+
+    def spotPages(self, url, key):
+        # Runs on a worker thread: yields the items of a Spotify paging object, found under key, page by page. The
+        # next page is only fetched when the caller asks for it.
+        while url:
+            code, page = self.spotGetJson(url, conditional=False)
+            page = (page or {}).get(key)
+            if not page:
+                break
+            yield page.get('items') or []
+            url = page.get('next')
 
-            strResponse = response.read().decode('utf-8')
-            return json.loads(strResponse)
+    def spotDevices(self):
+        try:
+            code, spotDevices = self.spotGetJson(self.spotifyApiUrl + '/me/player/devices')
+            return spotDevices
 
-        except urllib.error.URLError as err:
+        except urllib.error.HTTPError as err:
             Domoticz.Error("Unkown error: code: {code}, msg: {message}".format(
-                code=str(err.code), message=str(err.args)))
+                code=str(err.code), message=str(err.msg)))
+            return None
+        except urllib.error.URLError as err:
+            Domoticz.Error("Spotify devices not retrieved: {}".format(err.reason))
             return None
 
     def getUserVar(self):
         try:
-            variables = DomoticzAPI({'type': 'command', 'param': 'getuservariables'})
-
-            if variables:
-                valuestring = ""
-                missingVar = []
-                lstDomoticzVariables = list(self.spotifyToken.keys()) + self.spotifySearchParam
-                if "result" in variables:
-                    for intVar in lstDomoticzVariables:
-                        intVarName = Parameters["Name"] + '-' + intVar
-                        try:
-                            result = next((item for item in variables["result"] if item["Name"] == intVarName))
-                            if intVar in self.spotifyToken:
-                                self.spotifyToken[intVar] = result['Value']
-                            Domoticz.Debug(str(result))
-                        except:
-                            missingVar.append(intVar)
+            # the extra accounts start right after the hub has read the variables
+            if self.hub is None:
+                self.userVars.refresh()
+
+            missingVar = []
+            for intVar in self.spotifySearchParam + ([] if self.hub is None else ['code']):
+                result = self.userVars.get(self.varName(intVar))
+                if result is None:
+                    missingVar.append(intVar)
                 else:
-                    for intVar in lstDomoticzVariables:
-                        missingVar.append(intVar)
+                    Domoticz.Debug('User variable {name} exists'.format(name=result['Name']))
 
-                if len(missingVar) > 0:
-                    strMissingVar = ','.join(missingVar)
-                    Domoticz.Log("User Variable {} does not exist. Creation requested".format(strMissingVar))
-                    for variable in missingVar:
-                        DomoticzAPI({"type": "command", "param": "adduservariable",
-                                     "vname": Parameters["Name"] + '-' + variable, "vtype": "2", "vvalue": ""})
+            # optional settings are not created, the defaults apply when they do not exist
+            for option in self.spotifyOptions:
+                result = self.userVars.get(self.varName(option))
+                if result is not None:
+                    self.spotifyOptions[option] = result['Value']
 
-                return True
-            else:
-                raise Exception("Cannot read the uservariable holding the persistent variables")
+            # tokens are kept in the state file, user variables only hold them for older versions or as export
+            storedToken = {}
+            for intVar in self.spotifyToken:
+                result = self.userVars.get(self.varName(intVar))
+                if result is not None and result['Value']:
+                    storedToken[intVar] = result['Value']
+            if len(storedToken) == len(self.spotifyToken) and tokenDate(storedToken) > tokenDate(self.spotifyToken):
+                Domoticz.Log('Moving spotify tokens from the user variables to {}'.format(
+                    os.path.basename(self.state.path)))
+                self.spotifyToken.update(storedToken)
+                self.saveState()
+            # the tokens are safely on disk, the refresh token does not expire and should not stay readable in the
+            # user variables. They are removed after startup, off the path to ready.
+            self.legacyTokenVars = (bool(storedToken) and not self.exportTokens() and self.hasToken()
+                                    and self.saveState())
+
+            if len(missingVar) > 0:
+                strMissingVar = ','.join(missingVar)
+                Domoticz.Log("User Variable {} does not exist. Creation requested".format(strMissingVar))
+                for variable in missingVar:
+                    self.userVars.add(self.varName(variable), "")
+
+            if self.exportTokens():
+                self.saveUserVar()
+
+            return True
 
         except Exception as error:
             Domoticz.Error(str(error))
 
+    def exportTokens(self):
+        return self.spotifyOptions["exportTokens"].lower() in ('1', 'true', 'yes', 'on')
+
     def saveUserVar(self):
+        # Opt-in export of the tokens, missing variables are created
         try:
             for intVar in self.spotifyToken:
-                intVarName = Parameters["Name"] + '-' + intVar
-                DomoticzAPI({"type": "command", "param": "updateuservariable", "vname": intVarName, "vtype": "2",
-                             "vvalue": str(self.spotifyToken[intVar])})
+                intVarName = self.varName(intVar)
+                if self.userVars.get(intVarName) is None:
+                    self.userVars.add(intVarName, str(self.spotifyToken[intVar]))
+                else:
+                    self.userVars.update(intVarName, str(self.spotifyToken[intVar]))
         except Exception as error:
             Domoticz.Error(str(error))
 
@@ -235,16 +2160,17 @@ class BasePlugin:
             data = urllib.parse.urlencode(data)
 
             req = urllib.request.Request(url, data.encode('ascii'), headers)
-            response = urllib.request.urlopen(req)
+            response = self.transport.urlopen(req)
 
             strResponse = response.read().decode('utf-8')
-            Domoticz.Debug('Spotify response accestoken based on refresh: ' + str(strResponse))
-
             jsonResponse = json.loads(strResponse)
+            Domoticz.Debug('Spotify response accestoken based on refresh: ' + redactTokens(jsonResponse))
 
             self.saveSpotifyToken(jsonResponse)
         except:
             Domoticz.Error('Seems something with wrong with token response from spotify')
+            # try again in a minute
+            self.tokenRefresher.schedule(time.time() + self.tokenRefresher.margin + 60)
 
     def returnSpotifyBasicHeader(self):
         client_id = Parameters["Mode1"]
@@ -252,31 +2178,40 @@ class BasePlugin:
         login = client_id + ':' + client_secret
         base64string = base64.b64encode(login.encode())
         header = {'Authorization': 'Basic ' + base64string.decode('ascii')}
-        Domoticz.Debug('For basic headers using client_id: {client_id}, client_secret: {client_secret}'.format(
-            client_id=client_id, client_secret=client_secret))
+        Domoticz.Debug('For basic headers using client_id: {client_id}'.format(client_id=client_id))
 
         return header
 
+    def authorisationCode(self):
+        # the code of an extra account is given in its [name]-[account]-code user variable
+        if self.hub is None:
+            return Parameters["Mode3"]
+        result = self.userVars.get(self.varName('code'))
+        return result['Value'] if result is not None else ''
+
     def spotAuthoriseCode(self):
         try:
-            code = Parameters["Mode3"]
+            code = self.authorisationCode()
+            if not code:
+                Domoticz.Error('No code for account {account}, set user variable {variable} to the code received '
+                               'from spotify'.format(account=self.account, variable=self.varName('code')))
+                return False
             url = self.spotifyAccountUrl
             data = {'grant_type': 'authorization_code',
                     'code': code,
                     'redirect_uri': 'http://localhost'}
-            Domoticz.Debug('Getting tokens using data: {}'.format(data))
+            Domoticz.Debug('Getting tokens using authorisation code')
             data = urllib.parse.urlencode(data)
 
             headers = self.returnSpotifyBasicHeader()
-            Domoticz.Debug('Getting tokens using header: {}'.format(headers))
 
             try:
                 req = urllib.request.Request(url, data.encode('ascii'), headers)
-                response = urllib.request.urlopen(req)
+                response = self.transport.urlopen(req)
 
                 strResponse = response.read().decode('utf-8')
-                Domoticz.Debug('Spotify tokens based on authorisation code: ' + str(strResponse))
                 jsonResponse = json.loads(strResponse)
+                Domoticz.Debug('Spotify tokens based on authorisation code: ' + redactTokens(jsonResponse))
 
                 self.saveSpotifyToken(jsonResponse)
 
@@ -300,48 +2235,106 @@ class BasePlugin:
                 if intVar in response:
                     self.spotifyToken[intVar] = response[intVar]
             self.spotifyToken['retrievaldate'] = time.time()
-            Domoticz.Log('Succesfully got spotify tokens, saving data in user domoticz user variables')
-            self.saveUserVar()
+            self.tokenexpired = int(response.get('expires_in', TOKEN_LIFETIME))
+            self.tokenRefresher.schedule(self.spotifyToken['retrievaldate'] + self.tokenexpired)
+            Domoticz.Log('Succesfully got spotify tokens, saving them in {}'.format(
+                os.path.basename(self.state.path)))
+            self.saveState()
+            if self.exportTokens():
+                self.saveUserVar()
         except:
             Domoticz.Error('Seems something with wrong with token response from spotify')
 
-    def spotSearch(self, search_input, search_type):
-        url = self.spotifyApiUrl + "/search?q={search_query}&type={search_type}&market=NL&limit=10".format(
-            search_query=urllib.parse.quote(search_input), search_type=search_type)
-        Domoticz.Debug('Spotify search url: ' + str(url))
+    def spotSearch(self, search_input, search_type=None, market=None):
+        # One request for all types, search_type is only a hint for the ranking
+        market = market or self.spotifyOptions["market"] or SEARCH_MARKET
+        cacheKey = SearchCache.makeKey(search_input, search_type or 'any', market)
+        found, returnData = self.searchCache.get(cacheKey)
+        if not found:
+            # the same search may already be running for an earlier command or a preset
+            leader, event = self.searchCache.claim(cacheKey)
+            if leader:
+                try:
+                    return self.spotSearchRequest(cacheKey, search_input, search_type, market)
+                finally:
+                    self.searchCache.release(cacheKey)
+            event.wait(SEARCH_WAIT)
+            found, returnData = self.searchCache.get(cacheKey)
+            if not found:
+                return self.spotSearchRequest(cacheKey, search_input, search_type, market)
+
+        Domoticz.Debug('Spotify search result from cache: {result}, {stats}'.format(
+            result=str(returnData), stats=self.searchCache.stats()))
+        return returnData
 
-        headers = self.spotGetBearerHeader()
+    def spotSearchRequest(self, cacheKey, search_input, search_type, market):
+        url = self.spotifyApiUrl + "/search?q={search_query}&type={search_types}&market={market}&limit={limit}".format(
+            search_query=urllib.parse.quote(search_input), search_types=','.join(SEARCH_TYPES),
+            market=urllib.parse.quote(market), limit=SEARCH_LIMIT)
+        Domoticz.Debug('Spotify search url: ' + str(url))
 
-        req = urllib.request.Request(url, headers=headers)
-        response = urllib.request.urlopen(req)
+        code, jsonResponse = self.spotGetJson(url)
+        rankedItems = self.rankSearchItems(jsonResponse, search_input, search_type)
 
-        jsonResponse = json.loads(response.read().decode('utf-8'))
-        foundItems = jsonResponse['{}s'.format(search_type)]['items']
+        if not rankedItems:
+            Domoticz.Error('Nothing found on spotify for {search}'.format(search=search_input))
+            self.searchCache.put(cacheKey, None)
+            return None
 
-        Domoticz.Debug('First result of spotify search: ' + str(foundItems[0]))
+        bestItem = rankedItems[0]
+        Domoticz.Debug('Best result of spotify search: ' + str(bestItem))
 
-        rsltString = 'Found ' + search_type + ' ' + foundItems[0]['name']
-        if search_type == 'track':
-            tracks = []
-            for track in foundItems:
-                tracks.append(track['uri'])
+        rsltString = 'Found ' + bestItem['type'] + ' ' + bestItem['name']
+        if bestItem['type'] == 'track':
+            tracks = [bestItem['uri']]
+            for track in (jsonResponse.get('tracks') or {}).get('items') or []:
+                if track and track['uri'] not in tracks:
+                    tracks.append(track['uri'])
             returnData = {"uris": tracks}
         else:
-            returnData = {"context_uri": foundItems[0]['uri']}
+            returnData = {"context_uri": bestItem['uri']}
 
-        if search_type == 'album' or search_type == 'track':
-            rsltString += ' by ' + foundItems[0]['artists'][0]['name']
+        if bestItem['type'] == 'album' or bestItem['type'] == 'track':
+            rsltString += ' by ' + bestItem['artists'][0]['name']
 
         Domoticz.Log(rsltString)
+        self.searchCache.put(cacheKey, returnData)
         return returnData
 
+    def rankSearchItems(self, jsonResponse, search_input, search_type=None):
+        # Scores the items of all types: the type hint weighs most, then how well the name matches, then the
+        # position in Spotify's own ranking and the popularity (only artists and tracks have one)
+        query = ' '.join(search_input.lower().split())
+        scored = []
+        for type in SEARCH_TYPES:
+            items = (jsonResponse.get(type + 's') or {}).get('items') or []
+            for position, item in enumerate(items):
+                if not item or not item.get('uri'):
+                    continue
+                name = ' '.join(item.get('name', '').lower().split())
+                score = 0
+                if type == search_type:
+                    score += 100
+                if name == query:
+                    score += 50
+                elif name.startswith(query):
+                    score += 20
+                elif query in name:
+                    score += 10
+                score += 2 * (SEARCH_LIMIT - position)
+                score += item.get('popularity', 50) / 10.0
+                scored.append((score, item))
+
+        scored.sort(key=lambda entry: entry[0], reverse=True)
+        return [item for score, item in scored]
+
     def spotPause(self):
         try:
             url = self.spotifyApiUrl + "/me/player/pause"
             headers = self.spotGetBearerHeader()
 
             req = urllib.request.Request(url, headers=headers, method='PUT')
-            response = urllib.request.urlopen(req)
+            response = self.spotUrlopen(req)
             Domoticz.Log("Succesfully paused track")
 
         except urllib.error.HTTPError as err:
@@ -349,44 +2342,104 @@ class BasePlugin:
                 Domoticz.Error("User non premium")
             elif err.code == 400:
                 Domoticz.Error("Device id not found")
+            elif err.code == 429:
+                Domoticz.Error("Pause not sent, spotify rate limit reached")
             else:
                 Domoticz.Error("Unkown error, msg: " + str(err.msg))
+        except urllib.error.URLError as err:
+            Domoticz.Error("Pause not sent: {}".format(err.reason))
 
-    def spotCurrent(self):
+    def spotCurrent(self, priority=PRIORITY_POLL):
         try:
-            url = self.spotifyApiUrl + "/me/player"
-            headers = self.spotGetBearerHeader()
-
-            req = urllib.request.Request(url, headers=headers, method='GET')
-            response = urllib.request.urlopen(req)
+            code, resultJson = self.spotGetJson(self.spotifyApiUrl + "/me/player", priority)
 
             Domoticz.Debug("Succesfully retrieved current playing state")
-            Domoticz.Debug('Retrieved current playing state having code {}'.format(response.code))
+            Domoticz.Debug('Retrieved current playing state having code {}'.format(code))
 
-            return response
+            return code, resultJson
 
         except urllib.error.HTTPError as err:
-            Domoticz.Error("Unkown error {error}, msg: {message}".format(error=err.code, message=err.msg))
+            if err.code == 429:
+                Domoticz.Debug("Poll skipped, spotify rate limit reached: {}".format(self.rateLimiter.stats()))
+            else:
+                Domoticz.Error("Unkown error {error}, msg: {message}".format(error=err.code, message=err.msg))
+        except urllib.error.URLError as err:
+            Domoticz.Debug("Poll skipped: {}".format(err.reason))
 
-    def spotPlay(self, input, deviceLvl):
+    def spotControl(self, method, action, params=None):
+        # Runs on a worker thread: sends a player control like next or volume, returns whether spotify accepted it
         try:
+            url = self.spotifyApiUrl + "/me/player/" + action
+            if params:
+                url += "?" + urllib.parse.urlencode(params)
+            req = urllib.request.Request(url, headers=self.spotGetBearerHeader(), method=method)
+            self.spotUrlopen(req)
+            Domoticz.Debug("Succesfully sent {}".format(action))
+            return True
 
-            if deviceLvl not in self.spotArrDevices:
-                self.updateDeviceSelector()
-                if deviceLvl not in self.spotArrDevices:
-                    raise urllib.error.HTTPError(url='', msg='', hdrs='', fp='', code=404)
+        except urllib.error.HTTPError as err:
+            if err.code == 403:
+                Domoticz.Error("Error {}, you need to be premium member".format(action))
+            elif err.code == 404:
+                Domoticz.Error("Error {}, nothing is playing".format(action))
+            elif err.code == 429:
+                Domoticz.Error("{} not sent, spotify rate limit reached".format(action))
+            else:
+                Domoticz.Error("Unkown error, msg: " + str(err.msg))
+        except urllib.error.URLError as err:
+            Domoticz.Error("{action} not sent: {error}".format(action=action, error=err.reason))
+        return False
+
+    def spotSeek(self, step):
+        # Runs on a worker thread: moves the position step seconds. The last polled position is moved on by the time
+        # since, only when that ends up beyond the track the position is asked.
+        polled, resultJson = self.lastPlayback
+        position = None
+        if resultJson and resultJson.get('progress_ms') is not None:
+            position = resultJson['progress_ms']
+            if resultJson.get('is_playing'):
+                position += (time.time() - polled) * 1000
+            if position > ((resultJson.get('item') or {}).get('duration_ms') or 0):
+                position = None
+        if position is None:
+            result = self.spotCurrent(PRIORITY_COMMAND)
+            if not result or result[0] != 200 or not result[1]:
+                Domoticz.Error("Error seek, nothing is playing")
+                return False
+            position = result[1].get('progress_ms') or 0
+
+        return self.spotControl('PUT', 'seek', {"position_ms": max(0, int(position + step * 1000))})
+
+    def spotPlayMode(self, shuffle, repeat):
+        # Runs on a worker thread
+        return self.spotControl('PUT', 'shuffle', {"state": 'true' if shuffle else 'false'}) and \
+            self.spotControl('PUT', 'repeat', {"state": repeat})
+
+    def spotPlay(self, input, deviceLvl, strSelectorNames=None):
+        try:
+            dictOptions = None
+            if strSelectorNames is not None:
+                self.selectorIndex.syncNames(strSelectorNames)
+            device = self.selectorIndex.device(deviceLvl)
+            if device is None:
+                if strSelectorNames is None:
+                    raise urllib.error.HTTPError(url='', msg='', hdrs={}, fp=None, code=404)
+                dictOptions = self.buildDeviceSelector(strSelectorNames)
+                device = self.selectorIndex.device(deviceLvl)
+                if device is None:
+                    raise urllib.error.HTTPError(url='', msg='', hdrs={}, fp=None, code=404)
 
-            device = self.spotArrDevices[deviceLvl]
             url = self.spotifyApiUrl + "/me/player/play?device_id=" + device
             headers = self.spotGetBearerHeader()
 
             data = json.dumps(input).encode('utf8')
 
             req = urllib.request.Request(url, headers=headers, data=data, method='PUT')
-            response = urllib.request.urlopen(req)
-            self.updateDomoticzDevice(SPOTIFYDEVICES, 1, str(deviceLvl))
+            response = self.spotUrlopen(req)
             Domoticz.Log("Succesfully started playback")
 
+            return {"level": deviceLvl, "options": dictOptions, "device": device}
+
         except urllib.error.HTTPError as err:
             if err.code == 403:
                 Domoticz.Error("Error playback, you need to be premium member")
@@ -394,126 +2447,498 @@ class BasePlugin:
                 Domoticz.Error("Error playback, right scope requested?")
             elif err.code == 404:
                 Domoticz.Error("Device not found, went offline?")
+            elif err.code == 429:
+                Domoticz.Error("Playback not started, spotify rate limit reached")
             else:
                 Domoticz.Error("Unkown error, msg: " + str(err.msg))
+        except urllib.error.URLError as err:
+            Domoticz.Error("Playback not started: {}".format(err.reason))
+
+    def spotPlaySearchTxt(self, deviceLvl, strSelectorNames):
+        # Runs on a worker thread: reads the search string, searches and starts playback
+        searchString = self.userVars.read(self.varName('searchTxt'))
+        if searchString is None:
+            Domoticz.Error("User Variable {} does not exist".format(self.varName('searchTxt')))
+            return None
+        Domoticz.Log('Looking for ' + searchString)
+
+        searchType, strippedSearch = self.parseSearchString(searchString)
+        if not strippedSearch:
+            Domoticz.Error("Search string is empty, update user variable {}".format(self.varName('searchTxt')))
+            return None
+
+        Domoticz.Debug('Search type: ' + str(searchType))
+        Domoticz.Debug('Search string: ' + strippedSearch)
+        if searchType == QUEUE_TYPE:
+            return self.spotPlayTracks(strippedSearch, deviceLvl, strSelectorNames)
+
+        searchResult = self.spotSearch(strippedSearch, searchType)
+        if not searchResult:
+            return None
+
+        return self.spotPlay(searchResult, deviceLvl, strSelectorNames)
+
+    def spotPlayTracks(self, search_input, deviceLvl, strSelectorNames):
+        # Runs on a worker thread: plays all tracks found, up to the queueMax option. Playback starts with the first
+        # page, the later pages are added in the background (see spotExtendTracks).
+        market = self.spotifyOptions["market"] or SEARCH_MARKET
+        url = self.spotifyApiUrl + "/search?q={search_query}&type=track&market={market}&limit={limit}".format(
+            search_query=urllib.parse.quote(search_input), market=urllib.parse.quote(market), limit=QUEUE_PAGE_SIZE)
+        try:
+            limit = int(self.spotifyOptions["queueMax"] or QUEUE_MAX_TRACKS)
+        except ValueError:
+            limit = QUEUE_MAX_TRACKS
+
+        try:
+            pages = self.spotPages(url, 'tracks')
+            uris = [item['uri'] for item in next(pages, []) if item and item.get('uri')][:limit]
+        except urllib.error.HTTPError as err:
+            Domoticz.Error("Unkown error: code: {code}, msg: {message}".format(
+                code=str(err.code), message=str(err.msg)))
+            return None
+        except urllib.error.URLError as err:
+            Domoticz.Error("Tracks not retrieved: {}".format(err.reason))
+            return None
+        if not uris:
+            Domoticz.Error('No tracks found on spotify for {search}'.format(search=search_input))
+            return None
+
+        Domoticz.Log('Found tracks for {search}, playing the first {count}'.format(search=search_input,
+                                                                                count=len(uris)))
+        result = self.spotPlay({"uris": uris}, deviceLvl, strSelectorNames)
+        if result and limit > len(uris):
+            result["pages"] = (pages, uris, limit)
+        return result
+
+    def spotExtendTracks(self, pages, uris, device, limit, generation):
+        # Runs on a worker thread, as a command: fetches the later pages of a tracks search and plays all tracks
+        # found, at the track and position that is playing now. It gives up when playback has moved on to something
+        # else or a newer command came in.
+        tracks = 0
+        try:
+            later = (item['uri'] for items in pages for item in items if item and item.get('uri'))
+            uris = uris + list(itertools.islice(later, limit - len(uris)))
+            if not self.trackPages.current(generation):
+                return False
+
+            code, playback = self.spotGetJson(self.spotifyApiUrl + "/me/player", conditional=False)
+            fetched = time.time()
+            item = (playback or {}).get('item') or {}
+            if code != 200 or not playback.get('is_playing') or item.get('uri') not in uris or \
+                    (playback.get('device') or {}).get('id') != device:
+                Domoticz.Debug('Playback moved on, the rest of the tracks is not added')
+                return False
+            if not self.trackPages.current(generation):
+                return False
+
+            position = int((playback.get('progress_ms') or 0) + (time.time() - fetched) * 1000)
+            data = json.dumps({"uris": uris, "offset": {"position": uris.index(item['uri'])},
+                               "position_ms": position}).encode('utf8')
+            req = urllib.request.Request(self.spotifyApiUrl + "/me/player/play?device_id=" + device,
+                                         headers=self.spotGetBearerHeader(), data=data, method='PUT')
+            self.spotUrlopen(req)
+            tracks = len(uris)
+            Domoticz.Debug('Playing {count} tracks, continuing at {name}'.format(count=tracks,
+                                                                               name=item.get('name')))
+            return True
+
+        except urllib.error.HTTPError as err:
+            Domoticz.Error("Tracks not added: code: {code}, msg: {message}".format(
+                code=str(err.code), message=str(err.msg)))
+        except urllib.error.URLError as err:
+            Domoticz.Error("Tracks not added: {}".format(err.reason))
+        finally:
+            self.trackPages.done(generation, tracks)
+        return False
+
+    def parseSearchString(self, searchString):
+        # An optional first word artist, track, playlist or album is used as hint, tracks plays all tracks found
+        searchType = None
+        strippedSearch = searchString.strip()
+        words = strippedSearch.split(None, 1)
+        if words and words[0].lower() in SEARCH_TYPES + (QUEUE_TYPE,):
+            searchType = words[0].lower()
+            strippedSearch = words[1] if len(words) > 1 else ''
+        return searchType, strippedSearch
+
+    def refreshPresets(self):
+        # Runs on a worker thread: reads the preset variables and resolves the new, changed and stale presets
+        prefix = self.varName('preset-')
+        definitions = dict((name[len(prefix):], value) for name, value in self.userVars.startingWith(prefix).items())
+        resolved = {}
+        for name in self.presets.outdated(definitions):
+            try:
+                resolved[name] = self.resolvePreset(PresetTable.parse(definitions[name])[1])
+            except urllib.error.URLError as err:
+                Domoticz.Error('Preset {name} not resolved: {error}'.format(name=name, error=str(err)))
+                resolved[name] = None
+        return definitions, resolved
+
+    def resolvePreset(self, query):
+        if query.startswith('spotify:'):
+            uris = [uri.strip() for uri in query.split(',') if uri.strip()]
+            if ':track:' in uris[0]:
+                return {"uris": uris}
+            return {"context_uri": uris[0]}
+
+        searchType, strippedSearch = self.parseSearchString(query)
+        if not strippedSearch:
+            return None
+        # a preset holds a single play request, all tracks found are cut to the first results
+        if searchType == QUEUE_TYPE:
+            searchType = 'track'
+        return self.spotSearch(strippedSearch, searchType)
+
+    def onPresetsRefreshed(self, result):
+        definitions, resolved = result
+        if resolved:
+            Domoticz.Debug('Presets resolved: {}'.format(', '.join(sorted(resolved))))
+        if self.presets.apply(definitions, resolved):
+            self.saveState()
+
+    def onPlaybackStarted(self, result):
+        if result:
+            if result['options']:
+                self.applyDeviceSelector(result['options'])
+            self.updateDomoticzDevice(self.unit(SPOTIFYDEVICES), 1, result['level'])
+            if result.get('pages'):
+                # a command of its own, so a newer command drops it or runs after it
+                pages, uris, limit = result['pages']
+                self.commands.submit(self.spotExtendTracks,
+                                     (pages, uris, result['device'], limit, self.trackPages.start()))
+
+    def spotPlaybackState(self, submitted):
+        # Runs on a worker thread, returns the http code with the parsed playback state
+        if time.time() - submitted > POLL_STALE_AFTER:
+            Domoticz.Debug('Dropping stale poll, it waited behind other requests')
+            return None
+
+        return self.spotCurrent()
+
+    def onPlaybackState(self, result):
+        if result is None:
+            return None
+
+        code, resultJson = result
+        self.lastPlayback = (time.time(), resultJson if code == 200 else None)
+        delay = self.pollScheduler.update(code, resultJson)
+        Domoticz.Debug('Next poll in {delay} seconds, {polls} polls in the last hour'.format(
+            delay=int(delay), polls=self.pollScheduler.pollsPerHour()))
+
+        if code == 204 or (code == 200 and not resultJson):
+            # nothing is playing, the rest of a long result is not added to another session
+            self.trackPages.clear()
+            if Devices[self.unit(SPOTIFYDEVICES)].sValue != '0':
+                self.updateDomoticzDevice(self.unit(SPOTIFYDEVICES), 0, "0")
+        elif code == 200:
+            if not resultJson['is_playing']:
+                self.updateDomoticzDevice(self.unit(SPOTIFYDEVICES), 0, "0")
+            else:
+                deviceName = resultJson['device']['name']
+                if resultJson['device'].get('id'):
+                    self.selectorIndex.learn(deviceName, resultJson['device']['id'])
+                try:
+                    lstSelectorLevel = self.catchDeviceSelectorLvl(deviceName)
+                    self.updateDomoticzDevice(self.unit(SPOTIFYDEVICES), 1, lstSelectorLevel)
+                except ValueError:
+                    Domoticz.Debug(
+                        'Playing on device {device_name} which was unkown, trying to update domoticz device to '
+                        'correctly update playback information.'.format(device_name=str(deviceName)))
+                    self.engine.submit(self.spotDevices,
+                                       callback=lambda spotDevices: self.onUnknownDevice(spotDevices, deviceName))
+
+        self.updateNowPlaying(code, resultJson)
+        self.updateControls(code, resultJson)
+        Domoticz.Debug('Connection pool: {}'.format(self.transport.stats()))
+
+    def updateNowPlaying(self, code, resultJson):
+        # Fills the now playing devices from the polled playback state, the writer skips unchanged values
+        if code != 200 or not resultJson:
+            self.updateDomoticzDevice(self.unit(NOWPROGRESS), 0, "0")
+            return None
+
+        item = resultJson.get('item') or {}
+        if item:
+            self.updateDomoticzDevice(self.unit(NOWTRACK), 0, item.get('name', ''))
+            self.updateDomoticzDevice(self.unit(NOWARTIST), 0,
+                                      ', '.join(artist['name'] for artist in item.get('artists', [])))
+            self.updateDomoticzDevice(self.unit(NOWALBUM), 0, (item.get('album') or {}).get('name', ''))
+
+        volume = (resultJson.get('device') or {}).get('volume_percent')
+        if volume is not None:
+            self.updateDomoticzDevice(self.unit(NOWVOLUME), 0, str(volume))
+
+        if item.get('duration_ms') and resultJson.get('progress_ms') is not None:
+            progress = min(100, int(resultJson['progress_ms'] * 100 / item['duration_ms']))
+            self.updateDomoticzDevice(self.unit(NOWPROGRESS), 0, str(progress))
+
+    def updateControls(self, code, resultJson):
+        # Fills the control devices from the playback state, a device with a command in flight keeps the value it
+        # was given until the check after the command
+        if not self.controlBusy(self.unit(CONTROLS)):
+            self.updateDomoticzDevice(self.unit(CONTROLS), 0, "0")
+        if code != 200 or not resultJson:
+            return None
+
+        volume = (resultJson.get('device') or {}).get('volume_percent')
+        if volume is not None and self.unit(VOLUME) in Devices and not self.controlBusy(self.unit(VOLUME)):
+            if volume:
+                self.updateDomoticzDevice(self.unit(VOLUME), 2, str(volume))
+            else:
+                # muted, the level is kept for switching it on again
+                self.updateDomoticzDevice(self.unit(VOLUME), 0, Devices[self.unit(VOLUME)].sValue)
+
+        if resultJson.get('shuffle_state') is not None and not self.controlBusy(self.unit(PLAYMODE)):
+            mode = (bool(resultJson['shuffle_state']), resultJson.get('repeat_state') or 'off')
+            # shuffling a repeated track is shown as repeat track
+            level = next((level for level, levelMode in PLAYMODE_LEVELS.items() if levelMode == mode), '40')
+            self.updateDomoticzDevice(self.unit(PLAYMODE), 0 if level == '0' else 1, level)
+
+    def controlBusy(self, unit):
+        pending = self.controlPending.get(unit)
+        return pending is not None and time.time() - pending["since"] < CONTROL_PENDING_MAX
+
+    def onUnknownDevice(self, spotDevices, deviceName):
+        if spotDevices is None:
+            return None
+
+        self.updateDeviceSelector(spotDevices)
+        try:
+            lstSelectorLevel = self.catchDeviceSelectorLvl(deviceName)
+            self.updateDomoticzDevice(self.unit(SPOTIFYDEVICES), 1, lstSelectorLevel)
+        except ValueError:
+            Domoticz.Error("Current playing device not found by domoticz, cant update")
+
+    def onDevicesRefreshed(self, spotDevices):
+        # a 304 Not Modified hands back the same object, nothing to rebuild then
+        if spotDevices is not None and spotDevices is not self.knownSpotDevices:
+            self.knownSpotDevices = spotDevices
+            self.updateDeviceSelector(spotDevices)
+            self.saveState()
 
     def onHeartbeat(self):
+        self.engine.processResults()
+        self.deviceWriter.flush()
+
         if not self.blError:
-            if Parameters["Mode5"] != "0" and self.heartbeatCounterPoll == int(Parameters["Mode5"]):
-                Domoticz.Debug('Polling')
-                response = self.spotCurrent()
-                if response.code == 204 and Devices[SPOTIFYDEVICES].sValue != '0':
-                    self.updateDomoticzDevice(SPOTIFYDEVICES, 0, "0")
-                elif response.code == 200:
-                    resultJson = json.loads(response.read().decode('utf-8'))
-
-                    try:
-                        if not resultJson['is_playing']:
-                            self.updateDomoticzDevice(SPOTIFYDEVICES, 0, "0")
-                        else:
-                            lstSelectorLevel = catchDeviceSelectorLvl(resultJson['device']['name'])
-                            self.updateDomoticzDevice(SPOTIFYDEVICES, 1, lstSelectorLevel)
-
-                    except ValueError:
-                        try:
-                            Domoticz.Debug(
-                                'Playing on device {device_name} which was unkown, trying to update domoticz device to '
-                                'correctly update playback information.'.format(
-                                    device_name=str(resultJson['device']['name'])))
-                            self.updateDeviceSelector()
-                            lstSelectorLevel = catchDeviceSelectorLvl(resultJson['device']['name'])
-                            self.updateDomoticzDevice(SPOTIFYDEVICES, 1, lstSelectorLevel)
-                        except ValueError:
-                            Domoticz.Error("Current playing device not found by domoticz, cant update")
-
-                    except UnicodeEncodeError:
-                        # jsonresult is empty, meaning nothing is playing
-                        self.updateDomoticzDevice(SPOTIFYDEVICES, 0, "0")
-
-                self.heartbeatCounterPoll = 1
-            else:
-                self.heartbeatCounterPoll += 1
+            if self.startup.get("pending"):
+                return True
+
+            # one scheduler for all accounts: the polls that are due longest go first, as many per beat as the
+            # accounts need at their current intervals
+            due = [account for account in self.allAccounts() if account.ready() and account.pollScheduler.due()]
+            due.sort(key=lambda account: account.pollScheduler.nextPoll)
+            for account in due[:self.pollBudget()]:
+                account.poll()
+
+            if time.time() >= self.nextMetricsReport:
+                self.nextMetricsReport = time.time() + METRICS_INTERVAL
+                self.reportMetrics()
+
+            for account in self.allAccounts():
+                if account.ready():
+                    account.refreshInBackground()
 
             return True
 
+    def pollBudget(self):
+        rate = sum(account.pollScheduler.rate() for account in self.allAccounts() if account.ready())
+        return max(POLLS_PER_HEARTBEAT_MIN, int(math.ceil(rate * HEARTBEAT_INTERVAL)))
+
+    def ready(self):
+        return not self.blError and bool(self.startup) and not self.startup.get("pending")
+
+    def poll(self):
+        Domoticz.Debug('Polling {}'.format(self.account or 'spotify'))
+        self.pollScheduler.polling()
+        self.engine.submit(self.spotPlaybackState, (time.time(),), callback=self.onPlaybackState)
+
+    def refreshInBackground(self):
+        if time.time() >= self.nextDeviceRefresh:
+            # keep the device ids warm, so starting playback does not have to fetch them first
+            self.nextDeviceRefresh = time.time() + DEVICE_REFRESH
+            self.engine.submit(self.spotDevices, callback=self.onDevicesRefreshed)
+
+        if time.time() >= self.nextPresetRefresh:
+            self.nextPresetRefresh = time.time() + USERVAR_REFRESH
+            self.engine.submit(self.refreshPresets, callback=self.onPresetsRefreshed)
+
     def updateDomoticzDevice(self, idx, nValue, sValue):
-        if Devices[idx].sValue != sValue or Devices[idx].nValue != nValue:
-            Domoticz.Debug('Update for device {device_index} with nValue {device_value} and sValue {value_type}'.format(
-                device_index=idx, device_value=nValue, value_type=sValue))
-            Devices[idx].Update(nValue, sValue)
+        self.deviceWriter.update(idx, nValue, sValue)
 
     def onCommand(self, Unit, Command, Level, Hue):
         Domoticz.Debug(
             "Spotify: onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(
                 Level))
-        Domoticz.Debug(
-            "nValue={device_value}, sValue={value_type}".format(
-                device_value=str(Devices[SPOTIFYDEVICES].nValue), value_type=str(Devices[SPOTIFYDEVICES].sValue)))
+        if Unit in Devices:
+            Domoticz.Debug("nValue={device_value}, sValue={value_type}".format(
+                device_value=str(Devices[Unit].nValue), value_type=str(Devices[Unit].sValue)))
 
-        if Unit == SPOTIFYDEVICES:
-            try:
-                variables = DomoticzAPI({'type': 'command', 'param': 'getuservariables'})
-            except Exception as error:
-                Domoticz.Error(error)
+        self.engine.processResults()
 
+        account = self.accountForUnit(Unit)
+        if account is not None and not account.blError:
+            account.command(Unit, Command, Level)
+
+    def command(self, Unit, Command, Level):
+        if Unit in (self.unit(CONTROLS), self.unit(VOLUME), self.unit(PLAYMODE)):
+            self.control(Unit, Command, Level)
+
+        elif Unit == self.unit(SPOTIFYDEVICES):
+            self.pollScheduler.boost()
+            self.trackPages.clear()
             if Level == 0:
                 # Spotify turned off
                 self.updateDomoticzDevice(Unit, 0, str(Level))
-                self.spotPause()
+                self.commands.submit(self.spotPause)
 
             else:
-                searchVariable = next(
-                    (item for item in variables["result"] if item["Name"] == Parameters["Name"] + '-searchTxt'))
-                searchString = searchVariable['Value']
-                Domoticz.Log('Looking for ' + searchString)
-                searchResult = None
-
-                if searchString != "":
-                    for type in ['artist', 'track', 'playlist', 'album']:
-                        if type in searchString:
-                            strippedSearch = searchString.replace(type, '').lstrip()
-                            Domoticz.Debug('Search type: ' + type)
-                            Domoticz.Debug('Search string: ' + strippedSearch)
-                            searchResult = self.spotSearch(strippedSearch, type)
-                            break
-
-                if not searchResult:
-                    Domoticz.Error(
-                        "No correct type found in search string, use either artist, track, playlist or album")
-                else:
-                    self.spotPlay(searchResult, str(Level))
+                strSelectorNames = Devices[self.unit(SPOTIFYDEVICES)].Options['LevelNames']
+                self.selectorIndex.syncNames(strSelectorNames)
+                preset = self.presets.get(self.selectorIndex.name(str(Level)))
+                if preset is None:
+                    self.commands.submit(self.spotPlaySearchTxt, (str(Level), strSelectorNames),
+                                         callback=self.onPlaybackStarted)
+                    return None
+
+                # resolved preset, only the play request is needed
+                deviceName, target = preset
+                deviceLvl = self.selectorIndex.level(deviceName) if deviceName else str(Level)
+                if deviceLvl is None:
+                    Domoticz.Error('Device {} of the preset is not in the devices selector'.format(deviceName))
+                    return None
+                self.commands.submit(self.spotPlay, (target, deviceLvl, strSelectorNames),
+                                     callback=self.onPlaybackStarted)
+
+    def control(self, Unit, Command, Level):
+        # Transport controls are shown on the device right away. Shortly after spotify accepted the request a single
+        # playback state check confirms the state or sets the device back, a refused request sets it back at once.
+        device = Devices[Unit]
+        if Unit == self.unit(CONTROLS):
+            action = CONTROL_LEVELS.get(str(Level))
+            if action is None:
+                return None
+            nValue, sValue = 1, str(Level)
+            if action in ('back', 'forward'):
+                func, args = self.spotSeek, (SEEK_STEP if action == 'forward' else -SEEK_STEP,)
+            else:
+                func, args = self.spotControl, ('POST', action)
+            # every press counts, skipping twice skips two tracks
+            submit = self.engine.submit
+
+        elif Unit == self.unit(VOLUME):
+            if Command == 'Off':
+                volume, nValue, sValue = 0, 0, device.sValue
+            elif Command == 'On':
+                volume = int(device.sValue or 0) or VOLUME_DEFAULT
+                nValue, sValue = 2, str(volume)
+            else:
+                volume, nValue, sValue = Level, 2 if Level else 0, str(Level)
+            func, args = self.spotControl, ('PUT', 'volume', {"volume_percent": volume})
+            # dragging the slider sends a burst, the last level wins
+            submit = self.volumeCommands.submit
+
+        else:
+            mode = PLAYMODE_LEVELS.get(str(Level))
+            if mode is None:
+                return None
+            nValue, sValue = 0 if Level == 0 else 1, str(Level)
+            func, args = self.spotPlayMode, mode
+            submit = self.playModeCommands.submit
+
+        pending = self.controlPending.get(Unit)
+        if pending is None:
+            pending = self.controlPending[Unit] = {"previous": (device.nValue, device.sValue), "inflight": 0}
+        pending["inflight"] += 1
+        pending["since"] = time.time()
+        self.updateDomoticzDevice(Unit, nValue, sValue)
+        submit(func, args, callback=lambda sent: self.onControlSent(Unit, sent))
+
+    def onControlSent(self, Unit, sent):
+        if not sent:
+            # None when a newer command on the same device overtook it, False when spotify refused it
+            self.controlDone(Unit, None, sent is False)
+            return None
+
+        def check():
+            self.engine.submit(self.spotCurrent, (PRIORITY_COMMAND,),
+                               callback=lambda result: self.controlDone(Unit, result, False))
+        _timerWheel.schedule(CONTROL_CHECK_DELAY, check)
+
+    def controlDone(self, Unit, result, failed):
+        pending = self.controlPending.get(Unit)
+        if pending is None:
+            return None
+        pending["inflight"] -= 1
+        if pending["inflight"] > 0:
+            return None
+        del self.controlPending[Unit]
+
+        shown = (Devices[Unit].nValue, Devices[Unit].sValue)
+        if failed:
+            self.updateDomoticzDevice(Unit, *pending["previous"])
+        elif result is not None:
+            self.onPlaybackState(result)
+            if Unit != self.unit(CONTROLS) and (Devices[Unit].nValue, Devices[Unit].sValue) != shown:
+                Domoticz.Log('{device} was not changed by spotify, set back to {value}'.format(
+                    device=Devices[Unit].Name, value=Devices[Unit].sValue))
 
 
 _plugin = BasePlugin()
 
 
 def onStart():
-    _plugin.onStart()
+    if Parameters["Mode6"] == "Profile":
+        _profiler.start(Parameters["HomeFolder"])
+    if _profiler.enabled:
+        _profiler.call(_plugin.onStart)
+    else:
+        _plugin.onStart()
+
+
+def onStop():
+    _plugin.onStop()
 
 
 def onHeartbeat():
-    _plugin.onHeartbeat()
+    if _profiler.enabled:
+        _profiler.call(_plugin.onHeartbeat)
+    else:
+        _plugin.onHeartbeat()
 
 
 def onCommand(Unit, Command, Level, Hue):
-    _plugin.onCommand(Unit, Command, Level, Hue)
+    if _profiler.enabled:
+        _profiler.call(_plugin.onCommand, Unit, Command, Level, Hue)
+    else:
+        _plugin.onCommand(Unit, Command, Level, Hue)
 
 
 #############################################################################
 #                         Domoticz helper functions                         #
 #############################################################################
 
-def catchDeviceSelectorLvl(name):
-    lstSelectorNames = Devices[SPOTIFYDEVICES].Options['LevelNames'].split('|')
-    lstSelectorLevel = str(lstSelectorNames.index(name) * 10)
-    return lstSelectorLevel
+def tokenDate(token):
+    try:
+        return float(token.get('retrievaldate') or 0)
+    except ValueError:
+        return 0
+
+
+def redactTokens(response):
+    # token response for the log, the tokens themselves are left out
+    return str(dict((key, '(hidden)' if key in ('access_token', 'refresh_token') else value)
+                    for key, value in response.items()))
 
 
 def DomoticzAPI(APICall):
     resultJson = None
     url = "http://{}:{}/json.htm?{}".format(Parameters["Address"], Parameters["Port"],
                                             urllib.parse.urlencode(APICall, safe="&="))
-    Domoticz.Debug("Calling domoticz API: {}".format(url))
+    # variable values can hold exported tokens, they are not logged
+    logUrl = url if 'vvalue' not in APICall else "http://{}:{}/json.htm?{}".format(
+        Parameters["Address"], Parameters["Port"], urllib.parse.urlencode(dict(APICall, vvalue='(hidden)'), safe="&="))
+    Domoticz.Debug("Calling domoticz API: {}".format(logUrl))
     try:
         req = urllib.request.Request(url)
         if Parameters["Username"] != "":
@@ -524,11 +2949,20 @@ def DomoticzAPI(APICall):
             req.add_header('Authorization', 'Basic {}'.format(encoded_credentials.decode("ascii")))
         else:
             if Parameters["Mode4"] != "":
-                Domoticz.Debug("Add authentification using encoded credentials: {}".format(Parameters["Mode4"]))
+                Domoticz.Debug("Add authentification using encoded credentials")
                 encoded_credentials = Parameters["Mode4"]
                 req.add_header('Authorization', 'Basic {}'.format(encoded_credentials))
 
-        response = urllib.request.urlopen(req)
+        started = time.time()
+        try:
+            response = _domoticzTransport.urlopen(req)
+        except urllib.error.HTTPError as err:
+            _metrics.record('domoticz ' + APICall.get('param', ''), err.code, time.time() - started)
+            raise
+        except urllib.error.URLError:
+            _metrics.record('domoticz ' + APICall.get('param', ''), 'error', time.time() - started)
+            raise
+        _metrics.record('domoticz ' + APICall.get('param', ''), response.status, time.time() - started)
 
         if response.status == 200:
             resultJson = json.loads(response.read().decode('utf-8'))
@@ -537,19 +2971,24 @@ def DomoticzAPI(APICall):
         else:
             raise Exception("Domoticz API: http error = {}".format(response.status))
     except:
-        raise Exception("Error calling '{}'".format(url))
+        raise Exception("Error calling '{}'".format(logUrl))
 
     return resultJson
 
 
 #############################################################################
 #                       Local test helpers                                  #
+#   Benchmarks against local Spotify and Domoticz stand-ins: bench/run.py   #
 #############################################################################
 
-if local:
+if local and __name__ == '__main__':
     onStart()
 
     # onHeartbeat()
 
     # onCommand(1,'Off',0,'')
     onCommand(1, 'Set level', 20, '')
+
+    time.sleep(5)
+    onHeartbeat()
+    onStop()